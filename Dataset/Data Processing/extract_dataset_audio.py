@@ -1,36 +1,44 @@
 import os
-import csv
 import json
 import random
-from collections import deque
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from pydub import AudioSegment
+from gap_index import GAPFileIndex, TranscriptIndex
+from manifest import ManifestEntry, ManifestWriter, SEGMENT_MODES, annotation_hash, entry_audio_file_name, load_build_state, save_build_state, is_up_to_date
 
 # we set a seed to allow us to create different train / validate / test splits
 RANDOM_SEED = 2
 random.seed(RANDOM_SEED)
 
 
-def retrieve_details(filepath, speaker, start_time, num_prev):
+# number of worker processes used to extract GAP groups in parallel, 1 extracts serially
+NUM_WORKERS = 1
+
+# None writes only the '||'-delimited classification details files, 'csv' or 'jsonl' also writes a structured manifest with segment times
+MANIFEST_FORMAT = None
+
+# 'files' exports a WAV per growing prefix of each overlap, 'virtual' exports each overlap once and stores the prefix boundaries in a structured manifest
+SEGMENT_MODE = 'files'
+
+# only export audio for annotations that are new or changed since the previous run, and remove audio of annotations that no longer exist
+INCREMENTAL = False
+
+# number of decoded GAP recordings kept in memory, annotations are processed group by group so one is sufficient
+AUDIO_CACHE_SIZE = 1
+
+@lru_cache(maxsize=AUDIO_CACHE_SIZE)
+def load_audio(audio_filepath):
     """
-    Helper function dealing specifically with GAP dataset by retrieving the previous utterances and end time for a specific utterance.
+    Decodes a full GAP meeting recording. Results are held in a bounded LRU cache so each recording is decoded once and all of its segments are cut from the same buffer.
 
-    :param filepath: Path to the file to be read. For example relative path: '../GAP Dataset/Transcripts/Transcript Group 1 Feb 8 429.txt'
-    :param speaker: Speaker identifier (a colour as per GAP protocol)
-    :param start_time: Starting time of the utterance.
-    :param num_prev: Number of previous utterances to retrieve.
-    :returns: Tuple containing end time of the current utterance and list of previous utterances.
+    :param audio_filepath: Path to the audio file.
+    :returns: Decoded AudioSegment for the whole recording.
     """
-    with open(filepath, 'r') as f:
-        reader = csv.reader(f, delimiter='\t')  # assuming the file is tab-separated
-        next(reader)  # skip the header
-        conversation_history = deque(maxlen=num_prev)
-        for row in reader:
-            curr_speaker = row[0].split('.')[1]
-            if curr_speaker == speaker and row[1] == start_time:
-                return row[2], conversation_history
-            conversation_history.append(row[3])
-        print('Nothing was found for ', filepath, ' at time ', start_time)
+    return AudioSegment.from_wav(audio_filepath)
 
 def time_to_ms(time_str):
     """
@@ -44,43 +52,14 @@ def time_to_ms(time_str):
     # convert minutes and seconds to milliseconds and return the sum
     return int(minutes) * 60000 + float(seconds) * 1000
 
-def get_filepath(number, file_type):
-    """
-    Given a GAP dataset group number and a file type, retrieve the full path to the corresponding audio or transcript file.
-
-    :param number: Group number as a string.
-    :param file_type: Type of the file ('audio' or 'transcript').
-    :returns: Full path to the requested file.
-    """
-
-    if file_type == 'audio':
-        gap_audio_folder_path = '../GAP Dataset/Audio'
-        for filename in os.listdir(gap_audio_folder_path):
-            if not filename.startswith("MP4"):
-                continue
-            if filename.split(' ')[2] == number:
-                return os.path.join(gap_audio_folder_path, filename)
-    elif file_type == 'transcript':
-        gap_transcript_folder_path = '../GAP Dataset/Transcripts'
-        for filename in os.listdir(gap_transcript_folder_path):
-            if not filename.startswith("Transcript"):
-                continue
-            if filename.split(' ')[2] == number:
-                return os.path.join(gap_transcript_folder_path, filename)
-    else:
-        print('Invalid file type')
-
-
-
-
 audio_filepath = './Audio/MP4 Group 1 Feb 8 429.mp4.wav' # example
 
-def extract_audio(audio_filepath, start_time, end_time,segment_interval, conversational_history, classification, element=''):
+def extract_audio(audio_filepath, start_time, end_time,segment_interval, conversational_history, classification, segment_mode='files', export=True):
     """
     Firstly this function extracts audio segments from an audio file based on start and end times. 
-    Secondly it places the resulting audio file in the interruption-dataset/audio folder.
-    Thirdly it adds a dataset entry to the {train / test / validation}_classification_text.txt file which contains the conversational history, classification and link to the audio file.
-    Note: the classificaiton text file will be contained within a subdirectory of interruption-dataset corresponding to the seed which was used to split the train / test /validate sets.
+    Secondly it places the resulting audio file in the interruption-dataset/audio folder. In 'virtual' segment mode only the whole overlap is exported, and each segment is described by its boundaries within that file.
+    Thirdly it returns a dataset entry per segment for the {train / test / validation}_classification_details.txt file which contains the conversational history, classification, segment times and link to the audio file.
+    Note: entries are written by create_dataset rather than here, so that their order does not depend on the order in which worker processes finish.
 
     :param audio_filepath: Path to the audio file.
     :param start_time: Starting time for extraction in the format mm:ss.s.
@@ -88,19 +67,14 @@ def extract_audio(audio_filepath, start_time, end_time,segment_interval, convers
     :param segment_interval: Duration of each segment in milliseconds.
     :param conversational_history: List of previous utterances.
     :param classification: Classification of the audio segment.
-    :param element: Optional parameter to specify the dataset element (train, test, or validation) that the audio file should be placed in.
+    :param segment_mode: 'files' to export every segment, or 'virtual' to export the overlap once. Segment file names are kept as identifiers in both modes.
+    :param export: If False no audio is decoded or written and only the dataset entries are returned, used when the audio is up to date.
+    :returns: List of ManifestEntry tuples, one per audio segment.
     """
 
-    dataset_dir = os.path.join(os.getcwd(), './interruption-dataset')
-    # check if the '/Dataset' directory exists
-    if not os.path.exists(dataset_dir):
-        # create the '/Dataset' directory
-        os.mkdir(dataset_dir)
-        os.mkdir(os.path.join(dataset_dir, 'audio'))
-
     group_number = os.path.basename(audio_filepath).split(' ')[2]  # the group number is always the third element of the file name
 
-    audio = AudioSegment.from_wav(audio_filepath)
+    audio = load_audio(audio_filepath) if export else None
 
     start_time_ms = time_to_ms(start_time)
     end_time_ms = time_to_ms(end_time)
@@ -114,6 +88,14 @@ def extract_audio(audio_filepath, start_time, end_time,segment_interval, convers
     if remainder > 0:
         num_files += 1
 
+    overlap_file_name = None
+    if segment_mode == 'virtual':
+        overlap_file_name = f"Group {group_number}: {start_time} - {end_time}.wav"
+    if segment_mode == 'virtual' and export:
+        # the longest prefix holds every sample of the shorter ones, so the overlap is stored once and referenced by each segment
+        audio[start_time_ms:end_time_ms].export(os.path.join("./interruption-dataset/audio", overlap_file_name), format="wav")
+
+    entries = []
     segment_end_time_ms = start_time_ms 
     for i in range(1, num_files+1):
         # determine the start and end times for this segment
@@ -122,27 +104,68 @@ def extract_audio(audio_filepath, start_time, end_time,segment_interval, convers
         else:
             segment_end_time_ms = min(segment_end_time_ms +segment_interval, end_time_ms) 
         
-        segment = audio[start_time_ms:segment_end_time_ms] # extract segment
-
         file_name = f"Group {group_number}: {start_time} - {end_time} - {i}.wav"
-        output_filepath = os.path.join("./interruption-dataset/audio", file_name)
+        if segment_mode == 'files' and export:
+            segment = audio[start_time_ms:segment_end_time_ms] # extract segment
+            output_filepath = os.path.join("./interruption-dataset/audio", file_name)
+            segment.export(output_filepath, format="wav")
+        entries.append(ManifestEntry(file_name, classification, conversational_history, round(start_time_ms), round(segment_end_time_ms), i, overlap_file_name))
+    return entries
+
+def group_annotations(datasets):
+    """
+    Groups annotations by their GAP group number so that each recording only needs to be decoded once.
+    Groups are ordered by first appearance and annotations keep their original order within a group.
 
-        os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
-        segment.export(output_filepath, format="wav")
-        
-    
-        dataset_path = f'./interruption-dataset/{RANDOM_SEED}'
-        os.makedirs(dataset_path, exist_ok=True)
-        with open(os.path.join(dataset_path, f'{element}_classification_details.txt'), 'a') as f:
-            f.write(f"{file_name}||{classification}||{conversational_history}\n")
+    :param datasets: Dictionary mapping dataset element (train, test, or validation) to a list of annotations.
+    :returns: Ordered dictionary mapping group number to a list of (element, annotation) tuples.
+    """
+    groups = OrderedDict()
+    for element, dataset in datasets.items():
+        for annotation in dataset:
+            groups.setdefault(annotation['groupNumber'], []).append((element, annotation))
+    return groups
 
-def create_dataset(segment_length, num_prev):
+def process_group(audio_filepath, transcript_filepath, annotations, segment_length, num_prev, segment_mode, up_to_date):
+    """
+    Extracts the audio segments for every annotation of a single GAP group. This is the unit of work handed to each worker process when extracting in parallel.
+
+    :param audio_filepath: Path to the group's audio file.
+    :param transcript_filepath: Path to the group's transcript file.
+    :param annotations: List of (element, annotation) tuples belonging to the group.
+    :param segment_length: Length of each audio segment in milliseconds.
+    :param num_prev: Number of previous utterances to retrieve.
+    :param segment_mode: 'files' or 'virtual', see extract_audio.
+    :param up_to_date: Set of annotation hashes whose audio is already on disk and is not exported again.
+    :returns: List of (element, annotation hash, ManifestEntry) tuples in annotation order.
+    """
+    transcript_index = TranscriptIndex.load(transcript_filepath)
+    entries = []
+    for element, annotation in annotations:
+        start_time = annotation['startTime']
+        classification = annotation['classification']
+        key = annotation_hash(annotation, segment_length, num_prev, segment_mode)
+        end_time, conversational_history = transcript_index.retrieve_details(annotation['speakerId'], start_time, num_prev)
+        segment_entries = extract_audio(audio_filepath, start_time, end_time, segment_length, conversational_history[0], classification, segment_mode, export=key not in up_to_date)
+        entries.extend((element, key, entry) for entry in segment_entries)
+    load_audio.cache_clear()  # release the decoded recording before the next group is loaded
+    return entries
+
+def create_dataset(segment_length, num_prev, num_workers=1, manifest_format=None, segment_mode='files', incremental=False):
     """
     Creates a dataset by splitting the data into train, test, and validation sets, and extracting audio segments using the extract_audio helper function.
 
     :param segment_length: Length of each audio segment in milliseconds.
     :param num_prev: Number of previous utterances to retrieve.
+    :param num_workers: Number of worker processes, GAP groups are sharded across workers when greater than one. The output is identical to a serial run.
+    :param manifest_format: Optional structured manifest format ('csv' or 'jsonl') written alongside the classification details files.
+    :param segment_mode: 'files' exports every prefix segment, 'virtual' exports each overlap once and always writes a structured manifest holding the segment boundaries.
+    :param incremental: If True only annotations that are new or changed since the previous run have their audio exported, and audio of annotations no longer present is removed. Manifests are always rewritten in full.
     """
+    if segment_mode not in SEGMENT_MODES:
+        raise ValueError(f'Invalid segment mode: {segment_mode}')
+    if segment_mode == 'virtual' and manifest_format is None:
+        manifest_format = 'csv'  # the '||'-delimited text file cannot hold the segment boundaries
 
     # loop through all instances of data.json
     with open('data.json', 'r') as f:
@@ -164,16 +187,67 @@ def create_dataset(segment_length, num_prev):
     # Split into dictionary so we can process each element separately
     datasets = {'train': train_data, 'validation': validation_data, 'test': test_data}
 
-    for element, dataset in datasets.items():
-        for annotation in dataset:
-            start_time = annotation['startTime']
-            classification = annotation['classification']
-            audio_filepath = get_filepath(annotation['groupNumber'], 'audio')
-            transcript_filepath = get_filepath(annotation['groupNumber'], 'transcript')
-            end_time, conversational_history = retrieve_details(transcript_filepath, annotation['speakerId'], start_time, num_prev)
-            extract_audio(audio_filepath, start_time, end_time, segment_length, conversational_history[0], classification, element=element)
+    groups = group_annotations(datasets)
+    # scan the GAP Dataset folders once and fail early should any group be missing a file
+    file_index = GAPFileIndex()
+    file_index.validate(groups.keys())
+
+    # the output folders are created up front so that worker processes never race to create them
+    dataset_path = f'./interruption-dataset/{RANDOM_SEED}'
+    audio_folder_path = os.path.join('./interruption-dataset', 'audio')
+    os.makedirs(audio_folder_path, exist_ok=True)
+    os.makedirs(dataset_path, exist_ok=True)
+
+    # annotations are keyed by a hash of the fields which determine their audio, the audio of unchanged annotations is reused
+    build_state = load_build_state('./interruption-dataset') if incremental else {}
+    up_to_date = []
+    for annotations in groups.values():
+        keys = (annotation_hash(annotation, segment_length, num_prev, segment_mode) for _, annotation in annotations)
+        up_to_date.append({key for key in keys if is_up_to_date(build_state, key, audio_folder_path)})
+
+    # process one GAP group at a time so that each recording is decoded once and shared by all of its annotations
+    audio_filepaths = [file_index.get_filepath(group_number, 'audio') for group_number in groups]
+    transcript_filepaths = [file_index.get_filepath(group_number, 'transcript') for group_number in groups]
+    group_args = (audio_filepaths, transcript_filepaths, list(groups.values()), repeat(segment_length), repeat(num_prev), repeat(segment_mode), up_to_date)
+
+    # the manifest files stay open for the whole build and are only moved into place once every group has been extracted
+    with ManifestWriter(dataset_path, structured_format=manifest_format) as manifest_writer:
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                # map yields results in submission order, so the dataset entries are written in the same order as a serial run
+                new_build_state = write_dataset_entries(manifest_writer, executor.map(process_group, *group_args))
+        else:
+            new_build_state = write_dataset_entries(manifest_writer, map(process_group, *group_args))
+
+    if incremental:
+        # audio which no current annotation produced belongs to annotations that were removed or changed
+        current_files = {name for names in new_build_state.values() for name in names}
+        stale_files = {name for names in build_state.values() for name in names} - current_files
+        for name in stale_files:
+            if os.path.exists(os.path.join(audio_folder_path, name)):
+                os.remove(os.path.join(audio_folder_path, name))
+        num_reused = sum(len(keys) for keys in up_to_date)
+        print(f'Incremental build: {len(new_build_state) - num_reused} new or changed annotations, {num_reused} up to date, {len(stale_files)} stale audio files removed')
+    save_build_state('./interruption-dataset', new_build_state)
+
+def write_dataset_entries(manifest_writer, group_results):
+    """
+    Adds the dataset entries of each processed group to the corresponding {train / test / validation} manifest.
+
+    :param manifest_writer: ManifestWriter for the dataset being built.
+    :param group_results: Iterable of lists of (element, annotation hash, ManifestEntry) tuples, one list per group.
+    :returns: Build state mapping each annotation hash to the audio file names it produced.
+    """
+    build_state = {}
+    for entries in group_results:
+        for element, key, entry in entries:
+            manifest_writer.write(element, entry)
+            audio_file_names = build_state.setdefault(key, [])
+            if entry_audio_file_name(entry) not in audio_file_names:
+                audio_file_names.append(entry_audio_file_name(entry))
+    return build_state
 
 
 
 if __name__ == "__main__":
-    create_dataset(300, 1)
\ No newline at end of file
+    create_dataset(300, 1, num_workers=NUM_WORKERS, manifest_format=MANIFEST_FORMAT, segment_mode=SEGMENT_MODE, incremental=INCREMENTAL)
\ No newline at end of file
@@ -0,0 +1,156 @@
+import os
+import csv
+import pickle
+from collections import deque
+
+# bump this whenever the layout of the cached index changes so that stale caches are rebuilt
+INDEX_VERSION = 1
+TRANSCRIPT_CACHE_DIR = './transcript-index-cache'
+
+GAP_AUDIO_FOLDER_PATH = '../GAP Dataset/Audio'
+GAP_TRANSCRIPT_FOLDER_PATH = '../GAP Dataset/Transcripts'
+# GAP file names start with one of these prefixes, the group number is always the third element of the file name
+GAP_FILE_PREFIXES = {'audio': 'MP4', 'transcript': 'Transcript'}
+
+
+class GAPFileIndex:
+    """
+    Maps every GAP group number to its audio and transcript files using a single scan of the GAP Dataset folders.
+    Groups with a missing or duplicated file are recorded during the scan and reported by validate, rather than surfacing later as a None path.
+    """
+    def __init__(self, audio_folder_path=GAP_AUDIO_FOLDER_PATH, transcript_folder_path=GAP_TRANSCRIPT_FOLDER_PATH):
+        """
+        :param audio_folder_path: Path to the folder containing the GAP audio files.
+        :param transcript_folder_path: Path to the folder containing the GAP transcript files.
+        """
+        self.groups = {}
+        self.duplicates = {}
+        folder_paths = {'audio': audio_folder_path, 'transcript': transcript_folder_path}
+        for file_type, folder_path in folder_paths.items():
+            for filename in sorted(os.listdir(folder_path)):
+                if not filename.startswith(GAP_FILE_PREFIXES[file_type]):
+                    continue
+                number = filename.split(' ')[2]
+                files = self.groups.setdefault(number, {})
+                filepath = os.path.join(folder_path, filename)
+                if file_type in files:
+                    self.duplicates.setdefault((number, file_type), [files[file_type]]).append(filepath)
+                    continue
+                files[file_type] = filepath
+
+    def validate(self, group_numbers):
+        """
+        Checks that each group has exactly one audio file and one transcript file.
+
+        :param group_numbers: Iterable of group numbers as strings.
+        :raises ValueError: If any group is missing a file or has more than one candidate file.
+        """
+        problems = []
+        for number in sorted(set(group_numbers), key=lambda n: int(n) if n.isdigit() else n):
+            files = self.groups.get(number, {})
+            for file_type in GAP_FILE_PREFIXES:
+                if (number, file_type) in self.duplicates:
+                    problems.append(f'Group {number} has more than one {file_type} file: {self.duplicates[(number, file_type)]}')
+                elif file_type not in files:
+                    problems.append(f'Group {number} has no {file_type} file')
+        if problems:
+            raise ValueError('Invalid GAP Dataset folders:\n' + '\n'.join(problems))
+
+    def get_filepath(self, number, file_type):
+        """
+        Given a GAP dataset group number and a file type, retrieve the full path to the corresponding audio or transcript file.
+
+        :param number: Group number as a string.
+        :param file_type: Type of the file ('audio' or 'transcript').
+        :returns: Full path to the requested file.
+        :raises ValueError: If the file type is invalid or the group has no such file.
+        """
+        if file_type not in GAP_FILE_PREFIXES:
+            raise ValueError(f'Invalid file type: {file_type}')
+        try:
+            return self.groups[number][file_type]
+        except KeyError:
+            raise ValueError(f'Group {number} has no {file_type} file') from None
+
+
+class TranscriptIndex:
+    """
+    Parsed GAP transcript which answers "end time plus previous utterances for speaker X at time T" without re-reading the file.
+    The index is built once per transcript and cached on disk, the cache is invalidated whenever the transcript's modification time or size changes.
+    """
+    def __init__(self, filepath, utterances, lookup):
+        """
+        :param filepath: Path to the GAP transcript the index was built from.
+        :param utterances: List of utterance texts in transcript order.
+        :param lookup: Dictionary mapping (speaker, start time) to a tuple of (row index, end time).
+        """
+        self.filepath = filepath
+        self.utterances = utterances
+        self.lookup = lookup
+
+    @classmethod
+    def load(cls, filepath, cache_dir=TRANSCRIPT_CACHE_DIR):
+        """
+        Returns the index for a transcript, reading it from the on-disk cache when it is still valid and building it otherwise.
+
+        :param filepath: Path to the GAP transcript. For example relative path: '../GAP Dataset/Transcripts/Transcript Group 1 Feb 8 429.txt'
+        :param cache_dir: Directory holding cached indices, or None to disable the disk cache.
+        :returns: TranscriptIndex for the transcript.
+        """
+        stat = os.stat(filepath)
+        key = (INDEX_VERSION, stat.st_mtime_ns, stat.st_size)
+        cache_filepath = None
+        if cache_dir is not None:
+            cache_filepath = os.path.join(cache_dir, os.path.basename(filepath) + '.pkl')
+            if os.path.exists(cache_filepath):
+                with open(cache_filepath, 'rb') as f:
+                    cached = pickle.load(f)
+                if cached['key'] == key:
+                    return cls(filepath, cached['utterances'], cached['lookup'])
+
+        index = cls.build(filepath)
+        if cache_filepath is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first so an interrupted run never leaves a truncated cache behind
+            tmp_filepath = cache_filepath + '.tmp'
+            with open(tmp_filepath, 'wb') as f:
+                pickle.dump({'key': key, 'utterances': index.utterances, 'lookup': index.lookup}, f)
+            os.replace(tmp_filepath, cache_filepath)
+        return index
+
+    @classmethod
+    def build(cls, filepath):
+        """
+        Parses a GAP transcript into an index.
+
+        :param filepath: Path to the GAP transcript.
+        :returns: TranscriptIndex for the transcript.
+        """
+        utterances = []
+        lookup = {}
+        with open(filepath, 'r') as f:
+            reader = csv.reader(f, delimiter='\t')  # transcript files are tab-separated
+            next(reader)  # skip the header
+            for row in reader:
+                speaker = row[0].split('.')[1]
+                # keep the first occurrence to match a top-to-bottom scan of the transcript
+                lookup.setdefault((speaker, row[1]), (len(utterances), row[2]))
+                utterances.append(row[3])
+        return cls(filepath, utterances, lookup)
+
+    def retrieve_details(self, speaker, start_time, num_prev):
+        """
+        Retrieves the end time and previous utterances for a specific utterance.
+
+        :param speaker: Speaker identifier (a colour as per GAP protocol)
+        :param start_time: Starting time of the utterance.
+        :param num_prev: Number of previous utterances to retrieve.
+        :returns: Tuple containing end time of the current utterance and list of previous utterances, or None if the utterance is not found.
+        """
+        entry = self.lookup.get((speaker, start_time))
+        if entry is None:
+            print('Nothing was found for ', self.filepath, ' at time ', start_time)
+            return None
+        row_index, end_time = entry
+        conversation_history = deque(self.utterances[max(row_index - num_prev, 0):row_index], maxlen=num_prev)
+        return end_time, conversation_history
@@ -0,0 +1,159 @@
+import os
+import csv
+import json
+import hashlib
+from collections import namedtuple
+
+# a single audio segment of the dataset, times are in milliseconds relative to the start of the GAP recording
+# in virtual segment mode overlap_file_name is the single audio file holding the whole overlap, which starts at start_ms
+ManifestEntry = namedtuple('ManifestEntry', ['audio_file_name', 'classification', 'conversational_history', 'start_ms', 'end_ms', 'segment_index', 'overlap_file_name'], defaults=[None])
+
+# 'files' exports one audio file per prefix segment, 'virtual' exports each overlap once and records the prefix boundaries in the manifest
+SEGMENT_MODES = ('files', 'virtual')
+
+# optional structured manifests written alongside the '||'-delimited classification details files
+STRUCTURED_FORMATS = ('csv', 'jsonl')
+
+# records which audio files each annotation produced, allowing incremental rebuilds
+BUILD_STATE_FILE = 'build_state.json'
+BUILD_STATE_VERSION = 1
+
+# size of the write buffer used for each manifest file, entries are only flushed to disk once this fills up
+MANIFEST_BUFFER_SIZE = 1 << 20
+
+
+class ManifestWriter:
+    """
+    Writes the {train / test / validation}_classification_details.txt files for a dataset build.
+    Each file is opened once, buffered, and written to a temporary path which replaces the real file when the writer is closed. An interrupted build therefore never leaves a partially written manifest behind.
+    Optionally a structured CSV or JSONL manifest with the segment start / end times and index is written next to each text file.
+    """
+    def __init__(self, dataset_path, structured_format=None):
+        """
+        :param dataset_path: Folder containing the classification details files.
+        :param structured_format: None, 'csv' or 'jsonl'.
+        """
+        if structured_format is not None and structured_format not in STRUCTURED_FORMATS:
+            raise ValueError(f'Invalid manifest format: {structured_format}')
+        self.dataset_path = dataset_path
+        self.structured_format = structured_format
+        self.files = {}  # final filepath -> open temporary file
+        self.csv_writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def _open(self, filepath):
+        """
+        Returns the temporary file backing a manifest file, opening it on first use.
+        """
+        if filepath not in self.files:
+            self.files[filepath] = open(filepath + '.tmp', 'w', newline='', buffering=MANIFEST_BUFFER_SIZE)
+        return self.files[filepath]
+
+    def write(self, element, entry):
+        """
+        Adds a dataset entry to the manifest of a dataset element.
+
+        :param element: Dataset element (train, test, or validation).
+        :param entry: ManifestEntry for one audio segment.
+        """
+        text_filepath = os.path.join(self.dataset_path, f'{element}_classification_details.txt')
+        self._open(text_filepath).write(f"{entry.audio_file_name}||{entry.classification}||{entry.conversational_history}\n")
+
+        if self.structured_format == 'csv':
+            filepath = os.path.join(self.dataset_path, f'{element}_classification_details.csv')
+            if filepath not in self.csv_writers:
+                self.csv_writers[filepath] = csv.writer(self._open(filepath))
+                self.csv_writers[filepath].writerow(ManifestEntry._fields)
+            self.csv_writers[filepath].writerow(entry)
+        elif self.structured_format == 'jsonl':
+            filepath = os.path.join(self.dataset_path, f'{element}_classification_details.jsonl')
+            self._open(filepath).write(json.dumps(entry._asdict()) + '\n')
+
+    def close(self):
+        """
+        Flushes every manifest file and atomically moves it into place.
+        """
+        for filepath, f in self.files.items():
+            f.close()
+            os.replace(f.name, filepath)
+        self.files = {}
+        self.csv_writers = {}
+
+    def discard(self):
+        """
+        Removes the temporary files without touching any existing manifest.
+        """
+        for f in self.files.values():
+            f.close()
+            os.remove(f.name)
+        self.files = {}
+        self.csv_writers = {}
+
+
+def annotation_hash(annotation, segment_length, num_prev, segment_mode):
+    """
+    Hashes the fields of an annotation that determine the audio files it produces.
+
+    :param annotation: Annotation from data.json or aug_data.json.
+    :param segment_length: Length of each audio segment in milliseconds.
+    :param num_prev: Number of previous utterances retrieved.
+    :param segment_mode: 'files' or 'virtual'.
+    :returns: Hexadecimal digest identifying the annotation's audio.
+    """
+    key = [annotation['groupNumber'], annotation['startTime'], annotation['speakerId'], segment_length, num_prev, segment_mode]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+def entry_audio_file_name(entry):
+    """
+    Returns the audio file holding a segment's samples, which is the overlap's file for virtual segments.
+
+    :param entry: ManifestEntry for one audio segment.
+    """
+    return entry.overlap_file_name if entry.overlap_file_name is not None else entry.audio_file_name
+
+def load_build_state(dataset_dir):
+    """
+    Reads the build state of a previous run.
+
+    :param dataset_dir: Folder containing the dataset's audio folder.
+    :returns: Dictionary mapping annotation hash to the list of audio file names it produced, empty if there is no usable state.
+    """
+    filepath = os.path.join(dataset_dir, BUILD_STATE_FILE)
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath, 'r') as f:
+        state = json.load(f)
+    if state.get('version') != BUILD_STATE_VERSION:
+        return {}
+    return state['annotations']
+
+def save_build_state(dataset_dir, annotations):
+    """
+    Atomically writes the build state of the current run.
+
+    :param dataset_dir: Folder containing the dataset's audio folder.
+    :param annotations: Dictionary mapping annotation hash to the list of audio file names it produced.
+    """
+    filepath = os.path.join(dataset_dir, BUILD_STATE_FILE)
+    with open(filepath + '.tmp', 'w') as f:
+        json.dump({'version': BUILD_STATE_VERSION, 'annotations': annotations}, f)
+    os.replace(filepath + '.tmp', filepath)
+
+def is_up_to_date(build_state, key, audio_folder_path):
+    """
+    Checks whether an annotation's audio was produced by a previous run and is still on disk.
+
+    :param build_state: Build state returned by load_build_state.
+    :param key: Annotation hash.
+    :param audio_folder_path: Folder containing the dataset's audio files.
+    :returns: True if the audio can be reused, otherwise False.
+    """
+    return key in build_state and all(os.path.exists(os.path.join(audio_folder_path, name)) for name in build_state[key])
@@ -1,6 +1,64 @@
-from collections import deque
-from datetime import datetime, timedelta
+import os
 import csv
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gap_index import GAP_TRANSCRIPT_FOLDER_PATH, GAP_FILE_PREFIXES
+
+# we only count overlaps that are not in the first 300ms or last 10% of speech
+OVERLAP_ONSET_MS = 300
+LATE_ONSET_FRACTION = 10  # overlaps starting in the last 1/LATE_ONSET_FRACTION of the previous utterance are ignored
+# a gap of more than two seconds is marked as a short pause
+PAUSE_MS = 2000
+
+# one file per group is written here, in the layout read by method-2-augmentation/process_overlap_transcript.py
+OVERLAP_TRANSCRIPT_FOLDER_PATH = './Overlap Transcripts'
+
+
+def time_to_ms(time_str):
+    """
+    Converts a GAP timestamp in '%M:%S.%f' format to integer milliseconds.
+
+    :param time_str: Time string, for example '01:02.345'.
+    :returns: Time in milliseconds.
+    """
+    minutes, seconds = time_str.split(':')
+    seconds, _, fraction = seconds.partition('.')
+    return (int(minutes) * 60 + int(seconds)) * 1000 + int(fraction.ljust(3, '0')[:3])
+
+def compute_overlap_mask(start_ms, end_ms):
+    """
+    Checks for every utterance of a transcript if it overlaps with the previous one.
+
+    :param start_ms: Array of utterance start times in milliseconds.
+    :param end_ms: Array of utterance end times in milliseconds.
+    :returns: Boolean array, the first utterance is never an overlap.
+    """
+    prev_start, prev_end = start_ms[:-1], end_ms[:-1]
+    curr_start, curr_end = start_ms[1:], end_ms[1:]
+
+    basic_overlap_condition = prev_start < curr_end
+    immediate_overlap_condition = (curr_start - prev_start) > OVERLAP_ONSET_MS
+    # curr_start < prev_end - duration / 10, multiplied through by 10 to stay in integer arithmetic
+    not_early_onset_condition = LATE_ONSET_FRACTION * curr_start < LATE_ONSET_FRACTION * prev_end - (prev_end - prev_start)
+
+    mask = np.zeros(len(start_ms), dtype=bool)
+    mask[1:] = basic_overlap_condition & immediate_overlap_condition & not_early_onset_condition
+    return mask
+
+def compute_pause_mask(start_ms, end_ms):
+    """
+    Checks for every utterance of a transcript if it is preceded by a short pause, matching the comparison made by ConversationIterator.check_pause.
+
+    :param start_ms: Array of utterance start times in milliseconds.
+    :param end_ms: Array of utterance end times in milliseconds.
+    :returns: Boolean array, the first utterance is never preceded by a pause.
+    """
+    # check_pause is called once the current timestamp has already moved on to the new utterance, so its start is compared with its own end
+    mask = np.zeros(len(start_ms), dtype=bool)
+    mask[1:] = (start_ms[1:] - end_ms[1:]) > PAUSE_MS
+    return mask
 
 
 class ConversationIterator:
@@ -17,7 +75,10 @@ class ConversationIterator:
         :param context_length: Number of context utterances to provide when returning a case of overlapped speech
         """
         self.context_length = context_length
-        self.data = self.parse_GAP_file(data_filepath)
+        self.data, self.start_ms, self.end_ms = self.parse_GAP_file(data_filepath)
+        # overlaps and pauses are computed for the whole transcript up front rather than per utterance pair
+        self.overlaps = compute_overlap_mask(self.start_ms, self.end_ms)
+        self.pauses = compute_pause_mask(self.start_ms, self.end_ms)
         self.conversation_history = deque(maxlen=self.context_length)
         self.current_speaker = None
         self.current_timestamp = None
@@ -48,12 +109,14 @@ class ConversationIterator:
 
     def parse_GAP_file(self, filename):
         """
-        Preprocesses the GAP files to extract utterances into an ordered array format
+        Preprocesses the GAP files to extract utterances into an ordered array format, start and end times are converted to milliseconds once
 
         :param filename: Path to the GAP file
-        :returns: Parsed data from the GAP file
+        :returns: Tuple of parsed data from the GAP file, array of start times and array of end times in milliseconds
         """
         data = []
+        start_ms = []
+        end_ms = []
         with open(filename, 'r') as f:
             # transcript files are tab-separated
             reader = csv.reader(f, delimiter='\t') 
@@ -66,7 +129,9 @@ class ConversationIterator:
                 if speaker_colour not in users:
                     users[speaker_colour] = len(users) + 1
                 data[-1][0] = users[speaker_colour]
-        return data
+                start_ms.append(time_to_ms(row[1]))
+                end_ms.append(time_to_ms(row[2]))
+        return data, np.array(start_ms, dtype=np.int64), np.array(end_ms, dtype=np.int64)
 
     def _process_utterance(self, utterance, include_speaker):
         """
@@ -95,7 +160,7 @@ class ConversationIterator:
             self.current_timestamp = unprocessed_utterance[1:3]
             if self.index > 0:
                 self.current_overlap = self.check_overlap()
-                self.short_pause = self.check_pause(unprocessed_utterance[1])
+                self.short_pause = self.check_pause()
             utterance = self._process_utterance(unprocessed_utterance, True)
             self.conversation_history.append(utterance)
             self.index += 1
@@ -120,64 +185,80 @@ class ConversationIterator:
 
         :returns: True if overlaps, otherwise False
         """
-        # extract this processing code to a helper as it is used multiple times
-        prev_end_time = self.prev_timestamp[1]
-        prev_start_time = self.prev_timestamp[0]
-        curr_end_time = self.current_timestamp[1]
-        curr_start_time = self.current_timestamp[0]
-
-        # convert time strings to datetime objects
-        prev_start_datetime = datetime.strptime(prev_start_time, "%M:%S.%f")
-        prev_end_datetime = datetime.strptime(prev_end_time, "%M:%S.%f")
-        curr_start_datetime = datetime.strptime(curr_start_time, "%M:%S.%f")
-        curr_end_datetime = datetime.strptime(curr_end_time, "%M:%S.%f")
-
-        # we only count overlaps that are not in the first 300ms or last 10% of speech
-        basic_overlap_condition = prev_start_datetime < curr_end_datetime
-        immediate_overlap_condition = (curr_start_datetime - prev_start_datetime).total_seconds() > 0.3
-
-        prev_utterance_duration = prev_end_datetime - prev_start_datetime
-        early_onset_deadline = prev_end_datetime - (prev_utterance_duration / 10)
-        not_early_onset_condition = curr_start_datetime < early_onset_deadline
-
-        if basic_overlap_condition and immediate_overlap_condition and not_early_onset_condition:
-            return True
-        return False
+        return bool(self.overlaps[self.index])
 
-    
-    def check_pause(self, new_time):
+    def check_pause(self):
         """
-        Checks if there was a pause before the next utterance. A pause is deemed to have occurred if there is a gap of greater than two seconds between consecutive utterances.
+        Checks if there was a pause before the current utterance. A pause is deemed to have occurred if there is a gap of greater than two seconds.
 
-        :param new_time: Time of the next utterance
         :returns: True if there was a pause, otherwise False
         """
-        curr_time = self.current_timestamp[1]
+        return bool(self.pauses[self.index])
 
-        curr_datetime = datetime.strptime(curr_time, "%M:%S.%f")
-        new_datetime = datetime.strptime(new_time, "%M:%S.%f")
-        time_difference = new_datetime - curr_datetime
 
-        if time_difference > timedelta(seconds=2):
-            return True
-        return False
+def scan_transcript(transcript_filepath, output_folder_path=OVERLAP_TRANSCRIPT_FOLDER_PATH, context_length=5):
+    """
+    Writes every case of overlapped speech in a GAP transcript to 'Group N: current_overlaps.txt'. Each case is written as soon as it is found rather than collected in memory.
 
+    :param transcript_filepath: Path to the GAP transcript.
+    :param output_folder_path: Folder the overlap transcript is written to.
+    :param context_length: Number of context utterances included with each case.
+    :returns: Tuple of group number, overlap count and utterance count.
+    """
+    group_number = os.path.basename(transcript_filepath).split(' ')[2]  # the group number is always the third element of the file name
+    output_filepath = os.path.join(output_folder_path, f'Group {group_number}: current_overlaps.txt')
+    overlap_count = 0
+    utterance_count = 0
+    # write to a temporary file first so an interrupted scan never leaves a truncated overlap transcript behind
+    with open(output_filepath + '.tmp', 'w') as file:
+        for curr in ConversationIterator(transcript_filepath, context_length):
+            if curr['overlap']:
+                file.write(curr['timestamp'][0] + curr['transcript'] + '\n\n')
+                overlap_count += 1
+            utterance_count += 1
+    os.replace(output_filepath + '.tmp', output_filepath)
+    return group_number, overlap_count, utterance_count
 
-if __name__ == "__main__":
-    output = ""
-    transcript_filepath = "../GAP Dataset/Transcripts/Transcript Group 1 Feb 8 429.txt"
+def scan_corpus(transcript_folder_path=GAP_TRANSCRIPT_FOLDER_PATH, output_folder_path=OVERLAP_TRANSCRIPT_FOLDER_PATH, context_length=5, num_workers=None):
+    """
+    Scans every GAP transcript for overlapped speech, one transcript per worker process, and prints overlap statistics for the corpus.
+    Only the counts of each transcript are returned to the parent process, so memory use does not grow with the number of groups.
 
-    c = ConversationIterator(transcript_filepath)    
-    i = 1
-    overlap_count = 0
-    for curr in c:
-        if curr['overlap']:
-            output += curr['timestamp'][0]
-            output += curr['transcript'] + '\n\n'
-            overlap_count += 1
-        i += 1
+    :param transcript_folder_path: Folder containing the GAP transcripts.
+    :param output_folder_path: Folder the overlap transcripts are written to.
+    :param context_length: Number of context utterances included with each case.
+    :param num_workers: Number of worker processes, defaults to the number of CPUs.
+    :returns: List of (group number, overlap count, utterance count) tuples sorted by group number.
+    """
+    transcript_filepaths = [os.path.join(transcript_folder_path, filename) for filename in sorted(os.listdir(transcript_folder_path)) if filename.startswith(GAP_FILE_PREFIXES['transcript'])]
+    os.makedirs(output_folder_path, exist_ok=True)
 
-    print('OVERLAP COUNT:', overlap_count, 'Out of:', i)
+    results = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(scan_transcript, filepath, output_folder_path, context_length) for filepath in transcript_filepaths]
+        for future in futures:
+            group_number, overlap_count, utterance_count = future.result()
+            print(f'Group {group_number}: {overlap_count} overlaps out of {utterance_count} utterances')
+            results.append((group_number, overlap_count, utterance_count))
+    results.sort(key=lambda result: int(result[0]) if result[0].isdigit() else result[0])
+
+    total_overlaps = sum(result[1] for result in results)
+    total_utterances = sum(result[2] for result in results)
+    overlap_counts = [result[1] for result in results]
+    print('GROUPS:', len(results))
+    print('OVERLAP COUNT:', total_overlaps, 'Out of:', total_utterances)
+    if results:
+        print(f'Overlap rate: {total_overlaps / max(total_utterances, 1) * 100:.1f}%')
+        print(f'Overlaps per group: mean {np.mean(overlap_counts):.1f}, min {min(overlap_counts)}, max {max(overlap_counts)}')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scan the GAP transcripts for overlapped speech.')
+    parser.add_argument('--transcripts', default=GAP_TRANSCRIPT_FOLDER_PATH, help='folder containing the GAP transcripts')
+    parser.add_argument('--output', default=OVERLAP_TRANSCRIPT_FOLDER_PATH, help='folder the per-group overlap transcripts are written to')
+    parser.add_argument('--context-length', type=int, default=5, help='number of context utterances included with each case')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, defaults to the number of CPUs')
+    args = parser.parse_args()
 
-    with open('current_overlaps.txt', 'w') as file:
-        file.write(output)
\ No newline at end of file
+    scan_corpus(args.transcripts, args.output, args.context_length, args.workers)
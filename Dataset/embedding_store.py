@@ -0,0 +1,394 @@
+import os
+import json
+import hashlib
+import filecmp
+import numpy as np
+import pandas as pd
+
+# bump this whenever the layout of the store changes so that old stores are rejected rather than misread
+STORE_VERSION = 2
+# version 1 stores have no shared columns and read the same
+READABLE_STORE_VERSIONS = (1, 2)
+STORE_DTYPES = ('float16', 'float32')
+
+METADATA_FILE = 'store.json'
+ROWS_FILE = 'rows.csv'
+
+# statistics over the frames of each row that pooled embeddings can be made of, see load_pooled_embeddings
+POOLING_STATISTICS = ('mean', 'std', 'max')
+
+
+def read_metadata(path):
+    """
+    Reads the metadata of an embedding store.
+
+    :param path: Embedding store directory.
+    :returns: Dictionary with the store version, number of rows and the dtype, width and dimensionality of each embedding column.
+    :raises ValueError: If the store was written with a different layout.
+    """
+    with open(os.path.join(path, METADATA_FILE), 'r') as f:
+        metadata = json.load(f)
+    if metadata.get('version') not in READABLE_STORE_VERSIONS:
+        raise ValueError(f'Unsupported embedding store version in {path}: {metadata.get("version")}')
+    return metadata
+
+
+class EmbeddingStoreWriter:
+    """
+    Writes a dataset to an embedding store directory, replacing the base64-pickled tensors previously stored in CSV columns.
+    The non-embedding columns are written to rows.csv, and each embedding column to one contiguous array file holding every row's frames back to back, plus an offsets index giving the first frame of each row.
+    Embeddings are streamed to disk one row at a time, so a column never has to be held in memory.
+    """
+    def __init__(self, path, dtype='float32'):
+        """
+        :param path: Embedding store directory, created if it does not exist. Columns of an existing store are kept unless they are written again or write_rows is given different rows.
+        :param dtype: 'float16' halves the size of the store, 'float32' stores embeddings exactly.
+        """
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f'Invalid embedding store dtype: {dtype}')
+        self.path = path
+        self.dtype = dtype
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, METADATA_FILE)):
+            self.metadata = read_metadata(path)
+        else:
+            self.metadata = {'version': STORE_VERSION, 'num_rows': None, 'columns': {}}
+
+    def _set_num_rows(self, num_rows):
+        if self.metadata['num_rows'] is not None and self.metadata['num_rows'] != num_rows:
+            raise ValueError(f'Expected {self.metadata["num_rows"]} rows but {num_rows} were written')
+        self.metadata['num_rows'] = num_rows
+
+    def _save_metadata(self):
+        self.metadata['version'] = STORE_VERSION
+        filepath = os.path.join(self.path, METADATA_FILE)
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(filepath + '.tmp', filepath)
+
+    def _remove_column_files(self, name):
+        """
+        Removes the files of an embedding column and the pooled matrices cached from it.
+
+        :param name: Column name.
+        """
+        suffixes = ('.bin', '.offsets.npy', '.references.npy', '.ids.json')
+        for file_name in os.listdir(self.path):
+            if file_name in [name + suffix for suffix in suffixes] or file_name.startswith(f'{name}.pooled-'):
+                os.remove(os.path.join(self.path, file_name))
+
+    def write_rows(self, df):
+        """
+        Writes the non-embedding columns of a dataset, e.g. audio_file_name, classification and conversational_history.
+        If the store already holds different rows, its embedding columns no longer match them and are removed before the new rows replace the old.
+
+        :param df: Pandas dataframe with one row per dataset entry.
+        """
+        filepath = os.path.join(self.path, ROWS_FILE)
+        df.to_csv(filepath + '.tmp', index=False)
+        stale_columns = []
+        if self.metadata['num_rows'] is not None and not (os.path.exists(filepath) and filecmp.cmp(filepath + '.tmp', filepath, shallow=False)):
+            stale_columns = list(self.metadata['columns'])
+            self.metadata['columns'] = {}
+            self.metadata['num_rows'] = None
+        self._set_num_rows(len(df))
+        # the metadata is saved first, so it never describes columns of the old rows alongside the new ones
+        self._save_metadata()
+        for name in stale_columns:
+            self._remove_column_files(name)
+        os.replace(filepath + '.tmp', filepath)
+
+    def _write_embeddings(self, name, embeddings):
+        """
+        Writes the data file and offsets index of an embedding column.
+
+        :param name: Column name.
+        :param embeddings: Iterable of numpy arrays or CPU tensors, all of the same dimensionality and width.
+        :returns: Tuple of the number of embeddings written, their width and their dimensionality.
+        """
+        data_filepath = os.path.join(self.path, f'{name}.bin')
+        offsets_filepath = os.path.join(self.path, f'{name}.offsets.npy')
+        offsets = [0]
+        dim = None
+        ndim = None
+        # write to temporary files first so an interrupted run never leaves a truncated column behind
+        with open(data_filepath + '.tmp', 'wb') as f:
+            for embedding in embeddings:
+                array = np.asarray(embedding, dtype=self.dtype)
+                if ndim is None:
+                    ndim, dim = array.ndim, array.shape[-1]
+                if array.ndim != ndim or array.shape[-1] != dim:
+                    raise ValueError(f'Embedding of shape {array.shape} does not match the other rows of {name}')
+                array = np.ascontiguousarray(array.reshape(-1, dim))
+                f.write(array.tobytes())
+                offsets.append(offsets[-1] + array.shape[0])
+        with open(offsets_filepath + '.tmp', 'wb') as f:
+            np.save(f, np.array(offsets, dtype=np.int64))
+        os.replace(data_filepath + '.tmp', data_filepath)
+        os.replace(offsets_filepath + '.tmp', offsets_filepath)
+        return len(offsets) - 1, dim or 0, ndim or 2
+
+    def write_column(self, name, embeddings):
+        """
+        Writes an embedding column, one embedding per row in dataset order.
+
+        :param name: Column name, e.g. 'hubert_embeddings'.
+        :param embeddings: Iterable of numpy arrays or CPU tensors, either of shape (frames, dim) or of shape (dim,) for pooled embeddings such as BERT's.
+        :returns: Number of rows written.
+        """
+        num_rows, dim, ndim = self._write_embeddings(name, embeddings)
+        self._set_num_rows(num_rows)
+        self.metadata['columns'][name] = {'dtype': self.dtype, 'dim': dim, 'ndim': ndim}
+        self._save_metadata()
+        return num_rows
+
+    def write_shared_column(self, name, row_ids, embeddings):
+        """
+        Writes an embedding column whose rows repeat a smaller set of embeddings, such as the BERT embedding of the conversational history every segment of an overlap shares.
+        Each distinct embedding is stored once, and {name}.references.npy gives the position of each row's embedding among them. Readers see one embedding per row as with write_column.
+
+        :param name: Column name, e.g. 'bert_embeddings'.
+        :param row_ids: ID of each row's embedding in dataset order, e.g. a hash of the text it embeds.
+        :param embeddings: Dictionary mapping every ID in row_ids to its embedding, a numpy array or CPU tensor. IDs no row references are not stored.
+        :returns: Number of distinct embeddings written.
+        """
+        row_ids = list(row_ids)
+        ids = list(dict.fromkeys(row_ids))
+        positions = {embedding_id: i for i, embedding_id in enumerate(ids)}
+        num_embeddings, dim, ndim = self._write_embeddings(name, (embeddings[embedding_id] for embedding_id in ids))
+
+        references_filepath = os.path.join(self.path, f'{name}.references.npy')
+        ids_filepath = os.path.join(self.path, f'{name}.ids.json')
+        with open(references_filepath + '.tmp', 'wb') as f:
+            np.save(f, np.array([positions[embedding_id] for embedding_id in row_ids], dtype=np.int64))
+        with open(ids_filepath + '.tmp', 'w') as f:
+            json.dump(ids, f)
+        os.replace(references_filepath + '.tmp', references_filepath)
+        os.replace(ids_filepath + '.tmp', ids_filepath)
+
+        self._set_num_rows(len(row_ids))
+        self.metadata['columns'][name] = {'dtype': self.dtype, 'dim': dim, 'ndim': ndim, 'shared': True, 'num_embeddings': num_embeddings}
+        self._save_metadata()
+        return num_embeddings
+
+
+class EmbeddingColumn:
+    """
+    Read-only, memory-mapped embedding column. Indexing a row returns a view into the mapped file, no data is copied or decoded.
+    Rows of a shared column (see EmbeddingStoreWriter.write_shared_column) referencing the same embedding return views of the same data.
+    """
+    def __init__(self, path, name, info):
+        """
+        :param path: Embedding store directory.
+        :param name: Column name.
+        :param info: Column entry of the store metadata.
+        """
+        self.path = path
+        self.name = name
+        self.ndim = info['ndim']
+        # offsets of the distinct embeddings, which are the rows unless the column is shared
+        self.offsets = np.load(os.path.join(path, f'{name}.offsets.npy'))
+        self.references = np.load(os.path.join(path, f'{name}.references.npy')) if info.get('shared') else None
+        num_frames = int(self.offsets[-1])
+        if num_frames > 0:
+            self.data = np.memmap(os.path.join(path, f'{name}.bin'), dtype=info['dtype'], mode='r', shape=(num_frames, info['dim']))
+        else:
+            self.data = np.empty((0, info['dim']), dtype=info['dtype'])
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.references is None else len(self.references)
+
+    def embedding(self, position):
+        """
+        :param position: Index among the distinct embeddings, equal to the row index unless the column is shared.
+        :returns: View of shape (frames, dim), or (dim,) for pooled embeddings.
+        """
+        row = self.data[self.offsets[position]:self.offsets[position + 1]]
+        return row[0] if self.ndim == 1 else row
+
+    def __getitem__(self, idx):
+        """
+        :param idx: Row index.
+        :returns: View of shape (frames, dim), or (dim,) for pooled embeddings.
+        """
+        return self.embedding(idx if self.references is None else self.references[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def lengths(self):
+        """
+        :returns: Array with the number of frames of each row.
+        """
+        lengths = np.diff(self.offsets)
+        return lengths if self.references is None else lengths[self.references]
+
+    def ids(self):
+        """
+        :returns: List with the ID of each row's embedding for a shared column, e.g. the hash of its conversational history, or None for other columns.
+        """
+        if self.references is None:
+            return None
+        with open(os.path.join(self.path, f'{self.name}.ids.json'), 'r') as f:
+            ids = json.load(f)
+        return [ids[position] for position in self.references]
+
+    def convert(self, converter=None):
+        """
+        :param converter: Optional function applied to each embedding, e.g. to create a tensor.
+        :returns: List with one converted embedding per row. Each distinct embedding of a shared column is converted once, and the rows referencing it hold the same object.
+        """
+        if self.references is None:
+            return [converter(embedding) if converter is not None else embedding for embedding in self]
+        embeddings = [self.embedding(position) for position in range(len(self.offsets) - 1)]
+        if converter is not None:
+            embeddings = [converter(embedding) for embedding in embeddings]
+        return [embeddings[position] for position in self.references]
+
+
+class EmbeddingStore:
+    """
+    Read-only access to an embedding store written by EmbeddingStoreWriter. Only the requested embedding columns are mapped.
+    """
+    def __init__(self, path, columns=None):
+        """
+        :param path: Embedding store directory.
+        :param columns: Embedding columns to map, or None for every column in the store.
+        :raises ValueError: If a requested column is not in the store.
+        """
+        self.path = path
+        self.metadata = read_metadata(path)
+        names = list(self.metadata['columns']) if columns is None else columns
+        missing = [name for name in names if name not in self.metadata['columns']]
+        if missing:
+            raise ValueError(f'Embedding store {path} has no columns {missing}')
+        self.columns = {name: EmbeddingColumn(path, name, self.metadata['columns'][name]) for name in names}
+
+    def __len__(self):
+        return self.metadata['num_rows']
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def read_rows(self, columns=None):
+        """
+        :param columns: Non-embedding columns to read, or None for all of them.
+        :returns: Pandas dataframe of the non-embedding columns.
+        """
+        return pd.read_csv(os.path.join(self.path, ROWS_FILE), usecols=columns)
+
+    def to_dataframe(self, row_columns=None, converter=None):
+        """
+        Combines the non-embedding columns with the mapped embedding columns.
+
+        :param row_columns: Non-embedding columns to include, or None for all of them.
+        :param converter: Optional function applied to each embedding, e.g. to create a tensor. Without it the dataframe holds zero-copy views.
+        :returns: Pandas dataframe with one row per dataset entry.
+        """
+        df = self.read_rows(row_columns)
+        for name, column in self.columns.items():
+            df[name] = column.convert(converter)
+        return df
+
+
+def column_hash(path, name):
+    """
+    Hash identifying the current contents of an embedding column, used to invalidate anything derived from it.
+    Covers the column's metadata, its offsets index (and the references of a shared column) and the size and modification time of its data file, which change whenever EmbeddingStoreWriter writes the column again, without reading the data itself.
+
+    :param path: Embedding store directory.
+    :param name: Column name.
+    :returns: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    info = read_metadata(path)['columns'][name]
+    digest.update(json.dumps(info, sort_keys=True).encode())
+    for index_file in [f'{name}.offsets.npy'] + ([f'{name}.references.npy'] if info.get('shared') else []):
+        with open(os.path.join(path, index_file), 'rb') as f:
+            digest.update(f.read())
+    data_stat = os.stat(os.path.join(path, f'{name}.bin'))
+    digest.update(f'{data_stat.st_size}:{data_stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+def pool_column(column, statistics=('mean',)):
+    """
+    Reduces every row of an embedding column over its frames.
+
+    :param column: EmbeddingColumn.
+    :param statistics: Statistics from POOLING_STATISTICS, concatenated in the order given.
+    :returns: Float32 array of shape (rows, len(statistics) * dim). Rows without frames are zeros.
+    """
+    reducers = {'mean': np.mean, 'std': np.std, 'max': np.max}
+    dim = column.data.shape[1]
+    # the distinct embeddings are pooled, which are the rows unless the column is shared
+    pooled = np.zeros((len(column.offsets) - 1, len(statistics) * dim), dtype=np.float32)
+    for idx in range(len(pooled)):
+        # reduce in float32 even for float16 stores, whose sums would otherwise overflow
+        row = np.asarray(column.data[column.offsets[idx]:column.offsets[idx + 1]], dtype=np.float32)
+        if len(row) == 0:
+            continue
+        for i, statistic in enumerate(statistics):
+            pooled[idx, i * dim:(i + 1) * dim] = reducers[statistic](row, axis=0)
+    return pooled if column.references is None else pooled[column.references]
+
+
+def load_pooled_embeddings(path, name, statistics=('mean',)):
+    """
+    Loads an embedding column pooled over the frames of each row as one dense matrix, e.g. the mean HuBERT embedding the average-based models take as input.
+    The matrix is cached in the store directory ({name}.pooled-{statistics}.npy) together with the column_hash it was computed from. Later calls load the cache and it is recomputed only once the column has been written again.
+
+    :param path: Embedding store directory.
+    :param name: Column name. Columns holding one embedding per row, such as BERT's, are treated as rows of a single frame.
+    :param statistics: Statistics from POOLING_STATISTICS, concatenated in the order given.
+    :returns: Float32 array of shape (rows, len(statistics) * dim), in dataset order.
+    :raises ValueError: If a statistic is not in POOLING_STATISTICS.
+    """
+    statistics = tuple(statistics)
+    invalid = [statistic for statistic in statistics if statistic not in POOLING_STATISTICS]
+    if invalid or not statistics:
+        raise ValueError(f'Invalid pooling statistics: {invalid or statistics}')
+    cache_filepath = os.path.join(path, f'{name}.pooled-{"-".join(statistics)}.npy')
+    hash_filepath = cache_filepath[:-len('.npy')] + '.json'
+    source_hash = column_hash(path, name)
+    if os.path.exists(cache_filepath) and os.path.exists(hash_filepath):
+        with open(hash_filepath, 'r') as f:
+            if json.load(f).get('source_hash') == source_hash:
+                return np.load(cache_filepath)
+
+    pooled = pool_column(EmbeddingStore(path, [name])[name], statistics)
+    with open(cache_filepath + '.tmp', 'wb') as f:
+        np.save(f, pooled)
+    with open(hash_filepath + '.tmp', 'w') as f:
+        json.dump({'source_hash': source_hash, 'statistics': list(statistics)}, f)
+    # the matrix is replaced before its hash, so a stale hash can never vouch for a new matrix the other way round
+    os.replace(cache_filepath + '.tmp', cache_filepath)
+    os.replace(hash_filepath + '.tmp', hash_filepath)
+    return pooled
+
+
+def load_embedding_dataframe(path, columns, converter=None, pooled=None):
+    """
+    Loads a subset of the columns of an embedding store as a dataframe, in the column order given.
+
+    :param path: Embedding store directory.
+    :param columns: Column names, embedding and non-embedding columns may be mixed.
+    :param converter: Optional function applied to each embedding, see EmbeddingStore.to_dataframe.
+    :param pooled: Optional pooling statistics, see load_pooled_embeddings. If given, every embedding column of frames holds one pooled row per entry, as a view into the cached matrix, instead of its frames.
+    :returns: Pandas dataframe with the requested columns.
+    """
+    embedding_columns = [name for name in columns if name in read_metadata(path)['columns']]
+    if pooled is None:
+        store = EmbeddingStore(path, embedding_columns)
+        df = store.to_dataframe([name for name in columns if name not in embedding_columns], converter)
+    else:
+        store = EmbeddingStore(path, embedding_columns)
+        df = store.read_rows([name for name in columns if name not in embedding_columns])
+        for name in embedding_columns:
+            # columns that already hold one embedding per row are left as they are
+            if store[name].ndim == 1:
+                df[name] = store[name].convert(converter)
+            else:
+                df[name] = [converter(row) if converter is not None else row for row in load_pooled_embeddings(path, name, pooled)]
+    return df[list(columns)]
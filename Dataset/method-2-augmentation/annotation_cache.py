@@ -0,0 +1,112 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+RESPONSE_CACHE_PATH = './llm-response-cache.sqlite'
+CHECKPOINT_PATH = './augmentation-checkpoint.jsonl'
+
+
+def text_hash(*parts):
+    """
+    Hashes one or more strings into a single key.
+
+    :param parts: Strings to hash, for example the model name and the prompt.
+    :returns: Hexadecimal digest.
+    """
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM replies keyed by the model and a hash of the prompt, so a rerun never pays for the same prompt twice.
+    A single connection is shared by the pipeline's worker threads and guarded by a lock.
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH):
+        """
+        :param path: Path to the SQLite database, created if it does not exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, reply TEXT)')
+        self.connection.commit()
+
+    def get(self, model, prompt):
+        """
+        :param model: Name of the model queried.
+        :param prompt: Prompt sent to the model.
+        :returns: Cached reply, or None if the prompt has not been answered before.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT reply FROM responses WHERE key = ?', (text_hash(model, prompt),)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, model, prompt, reply):
+        """
+        Stores a reply, committing immediately so it survives a crash.
+
+        :param model: Name of the model queried.
+        :param prompt: Prompt sent to the model.
+        :param reply: Reply returned by the model.
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, model, reply) VALUES (?, ?, ?)', (text_hash(model, prompt), model, reply))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class Checkpoint:
+    """
+    Append-only JSONL record of every snippet group that has been fully processed, together with the backchannel timestamp it produced, if any.
+    Each line is flushed to disk as soon as the snippet completes, so an interrupted run loses at most the snippets still in flight.
+    """
+    def __init__(self, path=CHECKPOINT_PATH):
+        """
+        :param path: Path to the checkpoint file, created if it does not exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = {}  # snippet hash -> accepted timestamp or None
+        if os.path.exists(path):
+            with open(path, 'r+') as f:
+                content = f.read()
+                # drop a torn final line left by an interrupted write, that snippet is simply processed again
+                if content and not content.endswith('\n'):
+                    content = content[:content.rfind('\n') + 1]
+                    f.seek(0)
+                    f.write(content)
+                    f.truncate()
+            for line in content.splitlines():
+                record = json.loads(line)
+                self.completed[record['snippet']] = record['timestamp']
+
+    def is_completed(self, snippet):
+        return text_hash(snippet) in self.completed
+
+    def get(self, snippet):
+        """
+        :param snippet: Group of snippets.
+        :returns: Timestamp accepted for the snippet, or None if no backchannel was accepted.
+        """
+        return self.completed.get(text_hash(snippet))
+
+    def record(self, snippet, timestamp):
+        """
+        Appends a completed snippet to the checkpoint.
+
+        :param snippet: Group of snippets.
+        :param timestamp: Accepted backchannel timestamp, or None.
+        """
+        key = text_hash(snippet)
+        with self.lock:
+            self.completed[key] = timestamp
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'snippet': key, 'timestamp': timestamp}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
@@ -1,16 +1,35 @@
 import os
 import re
+import sys
+import csv
+import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import openai
+from annotation_cache import ResponseCache, Checkpoint
 
-# ensure we set the API key as an environment variable before running the script
+# the shared GAP helpers live alongside the manual annotation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data Processing'))
+from gap_index import GAPFileIndex
+
+# ensure we set the API key as an environment variable before running the script, it is checked in __main__ so the pipeline can be exercised offline with a stubbed openai.ChatCompletion.create
 openai_key = os.environ.get('OPENAI_KEY')
-if not openai_key:
-    raise ValueError("API key not found in environment variables.")
+
+# maximum number of requests in flight, shared by the first and second prompt stages
+MAX_CONCURRENCY = 4
+# sustained request rate and burst size allowed by the token bucket
+REQUESTS_PER_SECOND = 1.0
+BURST_SIZE = 4
+
+AUG_DATA_PATH = 'aug_data.json'
+
+# number of snippets of overlapped speech packed into each first prompt
+SNIPPETS_PER_PROMPT = 3
+SNIPPET_COUNT_WORDS = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten']
 
 augment_filepath = '../Data Processing/Overlap Transcripts'
-overlap_transcript_file = 'Group 28: current_overlaps.txt' # change this to file containing overlapped speech instances we wish to extract backchannels from
-file_path = os.path.join(augment_filepath, overlap_transcript_file)
+overlap_transcript_file = None # None annotates every file in augment_filepath, or set this to a single file containing overlapped speech instances, e.g. 'Group 28: current_overlaps.txt'
 
 def filter_snippets(content):
     """
@@ -29,21 +48,22 @@ def filter_snippets(content):
                 result.append(s + " <- evaluate here")
     return result
 
-def extract_snippets(filename):
+def extract_snippets(filename, snippets_per_prompt=SNIPPETS_PER_PROMPT):
     """
-    Given a file produced by parse_transcript as an input, we extract overlapped speech ('snippets'), process them using the filter_snippets helper function and group into groups of three.
+    Given a file produced by parse_transcript as an input, we extract overlapped speech ('snippets'), process them using the filter_snippets helper function and group them into prompts.
 
     :param filename: Name of the file to read snippets from.
-    :returns: List of grouped snippets. Each group contains up to three snippets.
+    :param snippets_per_prompt: Number of snippets in each group.
+    :returns: List of grouped snippets. Each group contains up to snippets_per_prompt snippets.
     """
     with open(filename, 'r') as file:
         content = file.read().strip().split("\n\n")
         # filter out instance of overlapped speech if second last turn or last turn contains laughter or noise
     content = filter_snippets(content)
-    # we group the instances of overlapped speech into threes
+    # we group the instances of overlapped speech, three per prompt by default
     grouped_snippets = []
-    for i in range(0, len(content), 3):
-        group = content[i:i+3]
+    for i in range(0, len(content), snippets_per_prompt):
+        group = content[i:i+snippets_per_prompt]
         grouped_string = '\n\n'.join(group)
         grouped_snippets.append(grouped_string)
 
@@ -94,40 +114,75 @@ def extract_answer_content(s):
             return content
     return None
 
-def add_sample_to_list(data, timestamp):
+def add_sample_to_list(data, timestamp, group_number, speaker_id):
     """
     Appends a new data sample to the provided list.
 
     :param data: List to which the sample will be added.
     :param timestamp: Timestamp string to be set as the 'startTime' of the new data sample.
+    :param group_number: GAP group number as a string.
+    :param speaker_id: Speaker identifier (a colour as per GAP protocol) of the backchannel.
     :returns: None
     """
     new_data = {
+        'groupNumber': group_number,
         'startTime': timestamp,
+        'speakerId': speaker_id,
         'classification': 'non-interruption'
     }
     data.append(new_data)
 
-def add_data_to_json(data, filename):
+def load_speaker_ids(transcript_filepath):
+    """
+    Maps the speaker numbers used in the overlap transcripts back to GAP speaker identifiers. Speakers are numbered in order of appearance, as in parse_transcript.
+
+    :param transcript_filepath: Path to the GAP transcript of the group.
+    :returns: Dictionary mapping (start time, speaker number) to the speaker identifier.
+    """
+    speaker_ids = {}
+    users = {}
+    with open(transcript_filepath, 'r') as f:
+        reader = csv.reader(f, delimiter='\t')  # transcript files are tab-separated
+        next(reader)  # skip the header
+        for row in reader:
+            speaker_colour = row[0].split('.')[1]
+            users.setdefault(speaker_colour, len(users) + 1)
+            speaker_ids.setdefault((row[1], users[speaker_colour]), speaker_colour)
+    return speaker_ids
+
+def find_speaker_number(snippet):
+    """
+    Returns the speaker number of the final utterance of a snippet, which is the potential backchannel.
+
+    :param snippet: Single snippet string.
+    :returns: Speaker number, or None if the final line does not start with a speaker.
+    """
+    match = re.match(r'Speaker (\d+):', snippet.strip().split('\n')[-1])
+    return int(match.group(1)) if match else None
+
+def add_data_to_json(data, filename=AUG_DATA_PATH):
     """
-    Appends provided data to the JSON augmented dataset file.
+    Appends provided data to the JSON augmented dataset file. Samples already present are skipped, so a resumed run does not duplicate them, and the file is replaced atomically.
 
     :param data: List of data samples to append.
     :param filename: Name of the JSON augmented dataset file.
     :returns: None
     """
-    with open('aug_data.json', 'r') as json_file:
+    with open(filename, 'r') as json_file:
         aug_data_list = json.load(json_file)
-    aug_data_list.extend(data)
-    with open('aug_data.json', 'w') as json_file:
-        json.dump(aug_data_list, json_file)
+    existing = {json.dumps(sample, sort_keys=True) for sample in aug_data_list}
+    aug_data_list.extend(sample for sample in data if json.dumps(sample, sort_keys=True) not in existing)
+    # write to a temporary file first so an interrupted write never leaves a truncated dataset behind
+    with open(filename + '.tmp', 'w') as json_file:
+        json.dump(aug_data_list, json_file, indent=4)
+    os.replace(filename + '.tmp', filename)
 
-first_prompt = """You are given three conversational snippets below separated by spaces and each starting with a timestamp. In each snippet an overlap of speech occurs between the last and second last turn, the last turn (where the <- evaluate this is) is where we are evaluating a potential backchannel. Please return only the timestamp of the backchannel, if any are, enclosed in <answer></answer> tags and give your reasoning beforehand in <reflection></reflection> tags. Only return an answer if confident.
+first_prompt = """You are given {count} conversational snippets below separated by spaces and each starting with a timestamp. In each snippet an overlap of speech occurs between the last and second last turn, the last turn (where the <- evaluate this is) is where we are evaluating a potential backchannel. Please return only the timestamp of the backchannel, if any are, enclosed in <answer></answer> tags and give your reasoning beforehand in <reflection></reflection> tags. Only return an answer if confident.
 
 Backchannel is defined as as a brief affirmation by a listener to what a speaker is saying through words or noises (for example, "agreed", "sure" or "mhmm"). Backchannel has no intent to take the turn of the conversation. Be careful of cases that sound like backchannel but are actually an answer to a question, for example where a 'yeah' overlaps in response to 'would you like a hotdog'. This is an answer to this question and takes the turn of the conversation. From this we can see that context is important in determining whether it is backchannel or not. 
 
 Here are the snippets:
-{}
+{snippets}
 """
 
 second_prompt = """In the below snippet an overlap of speech occurs between the last and second last turn, the last turn (where the <- evaluate this is) is where we are evaluating a potential backchannel. Please return true or false enclosed in <answer></answer> tags and give your reasoning beforehand in <reflection></reflection> tags. Only return an answer if confident.
@@ -138,12 +193,50 @@ Here is the snippet:
 {}
 """
 
-def query_gpt(prompt, model_="gpt-4", max_retries=10, initial_delay=1):
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of requests sent to the OpenAI API. Tokens are added at a constant rate up to a maximum capacity and every request takes one, waiting until a token is available.
+    """
+    def __init__(self, rate, capacity):
+        """
+        :param rate: Number of tokens added per second.
+        :param capacity: Maximum number of tokens, i.e. the largest burst of requests allowed.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, blocking until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def query_gpt(prompt, model_="gpt-4", max_retries=10, initial_delay=1, rate_limiter=None, cache=None):
+    # prompts answered by a previous run are served from the cache without a request
+    if cache is not None:
+        reply = cache.get(model_, prompt)
+        if reply is not None:
+            return reply
+
     delay = initial_delay
 
     # implementing exponential back-off
     for attempt in range(max_retries):
         try:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
             response = openai.ChatCompletion.create(
                 model=model_,
                 messages=[
@@ -156,6 +249,8 @@ def query_gpt(prompt, model_="gpt-4", max_retries=10, initial_delay=1):
             # extract the generated reply
             reply = response.choices[0].message.content
 
+            if cache is not None:
+                cache.put(model_, prompt, reply)
             return reply
 
         except (openai.error.ServiceUnavailableError, openai.error.RateLimitError) as e:
@@ -166,21 +261,150 @@ def query_gpt(prompt, model_="gpt-4", max_retries=10, initial_delay=1):
             else:
                 raise # re-raise the last exception if all attempts failed
 
-if __name__ == "__main__":
-    snippets = extract_snippets(file_path)
+def format_first_prompt(snippet):
+    """
+    :param snippet: Group of snippets produced by extract_snippets.
+    :returns: First prompt stating the number of snippets in the group.
+    """
+    count = snippet.count(' <- evaluate here')
+    return first_prompt.format(count=SNIPPET_COUNT_WORDS[count] if count < len(SNIPPET_COUNT_WORDS) else count, snippets=snippet)
+
+def find_candidate(snippet, in_flight, rate_limiter=None, cache=None):
+    """
+    First stage of the pipeline: asks the LLM which snippet, if any, contains a backchannel.
+
+    :param snippet: Group of snippets produced by extract_snippets.
+    :param in_flight: Semaphore bounding the number of requests in flight.
+    :param rate_limiter: Optional TokenBucket shared by every request.
+    :param cache: Optional ResponseCache shared by every request.
+    :returns: Tuple of the backchannel's timestamp and its snippet, or None if no backchannel was found.
+    """
+    with in_flight:
+        potential_answer = query_gpt(format_first_prompt(snippet), rate_limiter=rate_limiter, cache=cache)
+    timestamp = extract_answer_content(potential_answer)
+    # logic: if answer not None: we extract the relevant snippet and query one
+    if timestamp:
+        potential_noninterruption = extract_snippet(snippet, timestamp)
+        if potential_noninterruption:
+            return timestamp, potential_noninterruption
+    return None
+
+def confirm_candidate(timestamp, potential_noninterruption, in_flight, rate_limiter=None, cache=None):
+    """
+    Second stage of the pipeline: asks the LLM to confirm a single backchannel found by find_candidate.
+
+    :param timestamp: Timestamp of the potential backchannel.
+    :param potential_noninterruption: Snippet containing the timestamp.
+    :param in_flight: Semaphore bounding the number of requests in flight.
+    :param rate_limiter: Optional TokenBucket shared by every request.
+    :param cache: Optional ResponseCache shared by every request.
+    :returns: True if the backchannel was confirmed, otherwise False.
+    """
+    print('This is inserted into the second prompt: ', potential_noninterruption)
+    with in_flight:
+        final_reply = query_gpt(second_prompt.format(potential_noninterruption), rate_limiter=rate_limiter, cache=cache)
+    return process_final_answer(final_reply)
+
+def annotate_snippets(snippets, max_concurrency=MAX_CONCURRENCY, rate_limiter=None, cache=None, checkpoint=None):
+    """
+    Runs both prompts over every group of snippets. Each stage has its own thread pool so that second prompts are sent as soon as their first prompt has been answered, while the number of requests in flight never exceeds max_concurrency.
+
+    :param snippets: List of grouped snippets produced by extract_snippets.
+    :param max_concurrency: Maximum number of requests in flight.
+    :param rate_limiter: Optional TokenBucket shared by every request.
+    :param cache: Optional ResponseCache shared by every request.
+    :param checkpoint: Optional Checkpoint, snippets it already holds are skipped and every newly completed snippet is appended to it.
+    :returns: List with the confirmed backchannel timestamp of each group of snippets, or None where no backchannel was confirmed. The order matches snippets regardless of when each request completed.
+    """
+    in_flight = threading.BoundedSemaphore(max_concurrency)
+    confirmed = [None] * len(snippets)
+    pending = []
+    for i, snippet in enumerate(snippets):
+        if checkpoint is not None and checkpoint.is_completed(snippet):
+            confirmed[i] = checkpoint.get(snippet)
+        else:
+            pending.append(i)
+
+    def complete(i, timestamp):
+        confirmed[i] = timestamp
+        if checkpoint is not None:
+            checkpoint.record(snippets[i], timestamp)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as first_stage, ThreadPoolExecutor(max_workers=max_concurrency) as second_stage:
+        # each future maps to its snippet index and, for the second stage, the candidate timestamp
+        futures = {first_stage.submit(find_candidate, snippets[i], in_flight, rate_limiter, cache): (i, None) for i in pending}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, timestamp = futures.pop(future)
+                if timestamp is None:
+                    candidate = future.result()
+                    if candidate is not None:
+                        futures[second_stage.submit(confirm_candidate, *candidate, in_flight, rate_limiter, cache)] = (i, candidate[0])
+                    else:
+                        complete(i, None)
+                else:
+                    complete(i, timestamp if future.result() else None)
+    return confirmed
+
+def annotate_overlap_transcripts(filenames, snippets_per_prompt=SNIPPETS_PER_PROMPT, max_concurrency=MAX_CONCURRENCY, rate_limiter=None, cache=None, checkpoint=None):
+    """
+    Annotates the snippets of several overlap transcripts in a single pipeline run, so requests for different groups overlap rather than running one group at a time.
+    Snippets of different groups are never packed into the same prompt, as timestamps are only unique within a group.
+
+    :param filenames: Paths to files produced by parse_transcript, named 'Group N: current_overlaps.txt'.
+    :param snippets_per_prompt: Number of snippets packed into each first prompt.
+    :param max_concurrency: Maximum number of requests in flight.
+    :param rate_limiter: Optional TokenBucket shared by every request.
+    :param cache: Optional ResponseCache shared by every request.
+    :param checkpoint: Optional Checkpoint, see annotate_snippets.
+    :returns: List of complete augmented data samples.
+    """
+    file_index = GAPFileIndex()
+    snippets = []
+    group_numbers = []
+    for filename in filenames:
+        group_number = os.path.basename(filename).split(' ')[1].rstrip(':')  # the group number is always the second element of the file name
+        for snippet in extract_snippets(filename, snippets_per_prompt):
+            snippets.append(snippet)
+            group_numbers.append(group_number)
+    file_index.validate(set(group_numbers))
+
+    num_snippets = sum(snippet.count(' <- evaluate here') for snippet in snippets)
+    start = time.perf_counter()
+    confirmed = annotate_snippets(snippets, max_concurrency, rate_limiter, cache, checkpoint)
+    elapsed = time.perf_counter() - start
+    print(f'Annotated {num_snippets} snippets in {len(snippets)} prompts over {elapsed:.1f} seconds ({num_snippets / max(elapsed, 1e-9) * 60:.1f} snippets per minute)')
+
     data = []
-    # loop through snippets of overlapped speech calling query_gpt
-    for snippet in snippets:
-        potential_answer = query_gpt(first_prompt.format(snippet))
-        timestamp = extract_answer_content(potential_answer)
-        # logic: if answer not None: we extract the relevant snippet and query one
-        if timestamp:
-            potential_noninterruption = extract_snippet(snippet, timestamp)
-            if potential_noninterruption:
-                print('This is inserted into the second prompt: ', potential_noninterruption)
-                final_reply = query_gpt(second_prompt.format(potential_noninterruption))
-                final_answer = process_final_answer(final_reply)
-                if final_answer:
-                    add_sample_to_list(data, timestamp)
-                    print('Added the following timestamp to the report: ', timestamp)
-    add_data_to_json(data, './Automatic Annotations/' + overlap_transcript_file)
\ No newline at end of file
+    speaker_ids = {}
+    for snippet, group_number, timestamp in zip(snippets, group_numbers, confirmed):
+        if timestamp is None:
+            continue
+        if group_number not in speaker_ids:
+            speaker_ids[group_number] = load_speaker_ids(file_index.get_filepath(group_number, 'transcript'))
+        speaker_id = speaker_ids[group_number].get((timestamp, find_speaker_number(extract_snippet(snippet, timestamp))))
+        if speaker_id is None:
+            print('No speaker was found for group ', group_number, ' at time ', timestamp)
+            continue
+        add_sample_to_list(data, timestamp, group_number, speaker_id)
+        print('Added the following timestamp to the report: ', group_number, timestamp)
+    return data
+
+if __name__ == "__main__":
+    if not openai_key:
+        raise ValueError("API key not found in environment variables.")
+
+    if overlap_transcript_file is None:
+        filenames = [os.path.join(augment_filepath, filename) for filename in sorted(os.listdir(augment_filepath)) if filename.endswith('current_overlaps.txt')]
+    else:
+        filenames = [os.path.join(augment_filepath, overlap_transcript_file)]
+
+    rate_limiter = TokenBucket(REQUESTS_PER_SECOND, BURST_SIZE)
+    # replies and completed snippets persist across runs, so a rerun after a crash only queries the remaining snippets
+    cache = ResponseCache()
+    checkpoint = Checkpoint()
+    # snippets of overlapped speech from every file are sent to query_gpt concurrently, samples are returned in file and snippet order
+    data = annotate_overlap_transcripts(filenames, SNIPPETS_PER_PROMPT, MAX_CONCURRENCY, rate_limiter, cache, checkpoint)
+    cache.close()
+    add_data_to_json(data)
@@ -0,0 +1,127 @@
+import os
+import struct
+from functools import lru_cache
+import numpy as np
+import torch
+
+# shared by generate_embeddings.ipynb and the VAD notebooks, which import it with sys.path.append('../../Dataset')
+
+# numpy type and full scale value of the samples of each supported PCM bit depth
+WAV_DTYPES = {8: ('u1', 128), 16: ('<i2', 2**15), 32: ('<i4', 2**31)}
+
+
+@lru_cache(maxsize=64)
+def read_wav_memmap(filepath):
+    """
+    Memory-maps the PCM samples of a WAV file read-only, without decoding or copying the audio.
+
+    :param filepath: Path to the WAV file.
+    :returns: Tuple of the samples as an array of shape (frames, channels), the sample rate and the full scale value of the sample type.
+    """
+    with open(filepath, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'Not a WAV file: {filepath}')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'No data chunk found in {filepath}')
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                data_offset = f.tell()
+                break
+            chunk = f.read(chunk_size + chunk_size % 2)  # chunks are padded to an even number of bytes
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', chunk[:16])
+    if fmt is None:
+        raise ValueError(f'No fmt chunk found in {filepath}')
+    audio_format, channels, sample_rate, _, _, bits_per_sample = fmt
+    if audio_format not in (1, 0xFFFE) or bits_per_sample not in WAV_DTYPES:
+        raise ValueError(f'Unsupported WAV encoding in {filepath}')
+    dtype, full_scale = WAV_DTYPES[bits_per_sample]
+    num_frames = chunk_size // (channels * bits_per_sample // 8)
+    samples = np.memmap(filepath, dtype=dtype, mode='r', offset=data_offset, shape=(num_frames, channels))
+    return samples, sample_rate, full_scale
+
+def segment_num_frames(start_ms, end_ms, sample_rate):
+    """
+    :param start_ms: Start of the segment in ms within the recording.
+    :param end_ms: End of the segment in ms within the recording.
+    :param sample_rate: Sample rate of the audio.
+    :returns: Number of frames of the segment. pydub cuts at whole frames from the start of the recording, we match the frame the exported segment would have ended on.
+    """
+    return int(end_ms * sample_rate / 1000) - int(start_ms * sample_rate / 1000)
+
+
+class SegmentAudio:
+    """
+    Locates and loads the audio of the dataset's segments. By default every segment was exported to its own WAV file. With SEGMENT_MODE = 'virtual' in extract_dataset_audio.py each overlap was exported once, and its segments are the prefixes given by the boundaries in the {element}_classification_details.csv manifest.
+    Virtual segments are sliced from the memory-mapped audio file of their overlap, so no per-segment file is read.
+    """
+    def __init__(self, audio_folder, virtual):
+        """
+        :param audio_folder: Folder of the exported audio files.
+        :param virtual: True for virtual segments, whose boundaries must be added with add_boundaries.
+        """
+        self.audio_folder = audio_folder
+        self.virtual = virtual
+        self.boundaries = {} # segment's audio file name -> (overlap file name, start ms, end ms)
+
+    def add_boundaries(self, df):
+        """
+        Records the boundaries of each virtual segment within its overlap's audio file.
+
+        :param df: DataFrame with 'audio_file_name', 'overlap_file_name', 'start_ms' and 'end_ms' columns.
+        """
+        for row in df.itertuples():
+            self.boundaries[row.audio_file_name] = (row.overlap_file_name, row.start_ms, row.end_ms)
+
+    def source(self, file_name):
+        """
+        :param file_name: Name of the segment, e.g. 'Group 1: 14:06.8 - 14:07.5 - 1.wav'.
+        :returns: Tuple of the audio file the segment is read from, and its start and end in ms within that file (None for a whole file).
+        """
+        if not self.virtual:
+            return os.path.join(self.audio_folder, file_name), None, None
+        overlap_file_name, start_ms, end_ms = self.boundaries[file_name]
+        return os.path.join(self.audio_folder, overlap_file_name), start_ms, end_ms
+
+    def read_virtual(self, file_name):
+        """
+        Slices a virtual segment from the audio file of its overlap. The slice is a view of the memory-mapped file, only the returned float copy is materialised.
+
+        :param file_name: Name of the segment.
+        :returns: Tuple of the float32 samples of shape (frames, channels), scaled to [-1, 1) as by torchaudio.load, and their sample rate.
+        """
+        filepath, start_ms, end_ms = self.source(file_name)
+        samples, sample_rate, full_scale = read_wav_memmap(filepath)
+        segment = samples[:segment_num_frames(start_ms, end_ms, sample_rate)].astype(np.float32)
+        if samples.dtype == np.uint8:
+            segment -= full_scale
+        return segment / full_scale, sample_rate
+
+    def length(self, file_name):
+        """
+        Reads the length of a virtual segment from its boundaries and the WAV header, without decoding the audio.
+
+        :param file_name: Name of the segment.
+        :returns: Tuple of the number of frames and the sample rate.
+        """
+        filepath, start_ms, end_ms = self.source(file_name)
+        _, sample_rate, _ = read_wav_memmap(filepath)
+        return segment_num_frames(start_ms, end_ms, sample_rate), sample_rate
+
+    def load_waveform(self, file_name):
+        """
+        Loads a segment as a (channels, frames) float tensor in the same way as torchaudio.load.
+
+        :param file_name: Name of the segment.
+        :returns: Tuple of the waveform tensor and its sample rate.
+        """
+        if not self.virtual:
+            # only needed for whole files, generate_embeddings.ipynb reads those with librosa instead
+            import torchaudio
+            return torchaudio.load(self.source(file_name)[0])
+        segment, sample_rate = self.read_virtual(file_name)
+        return torch.from_numpy(np.ascontiguousarray(segment.T)), sample_rate
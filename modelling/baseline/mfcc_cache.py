@@ -0,0 +1,190 @@
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from torchaudio.transforms import MFCC
+
+# shared by the VAD notebooks, which import it from their own folder
+
+#### Edit variables and filepaths here ####
+N_MFCC = 13
+MELKWARGS = {"n_fft": 400, "hop_length": 160, "n_mels": 23, "center": False}
+WORKERS = max(1, (os.cpu_count() or 1) - 1)
+CHUNK_SIZE = 32 # files sent to a worker at a time
+
+CACHE_VERSION = 1
+INDEX_FILE = 'index.json'
+FEATURES_FILE = 'features.bin'
+HASH_BLOCK_SIZE = 1 << 20
+FRAME_BYTES = 4 * N_MFCC # one float32 frame of the features file
+
+# one MFCC transform per sample rate in each process, rather than one per file
+MFCC_TRANSFORMS = {}
+# load_waveform of the pool a worker belongs to, inherited when the worker is forked rather than pickled with every chunk
+WORKER_LOAD_WAVEFORM = None
+
+
+def mfcc_settings():
+    """
+    :returns: Dictionary of everything the cached features depend on besides the audio, stored in the index so that changing it invalidates the cache.
+    """
+    return {'version': CACHE_VERSION, 'n_mfcc': N_MFCC, 'melkwargs': MELKWARGS}
+
+def compute_mfcc(waveform, sample_rate):
+    """
+    :param waveform: Tensor of shape (channels, samples).
+    :param sample_rate: Sample rate of the waveform.
+    :returns: Tensor of shape (frames, N_MFCC), the MFCCs of each channel averaged, as the VAD collate functions did for stereo audio.
+    """
+    if sample_rate not in MFCC_TRANSFORMS:
+        MFCC_TRANSFORMS[sample_rate] = MFCC(sample_rate=sample_rate, n_mfcc=N_MFCC, melkwargs=MELKWARGS)
+    with torch.inference_mode():
+        return MFCC_TRANSFORMS[sample_rate](waveform).mean(0).transpose(0, 1)
+
+def file_content_hash(filepath):
+    """
+    :param filepath: Path to an audio file.
+    :returns: SHA-1 hex digest of the file's bytes.
+    """
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_fingerprint(filepath):
+    """
+    :param filepath: Path to an audio file.
+    :returns: List of the file's size and modification time, which decide whether its content hash must be recomputed.
+    """
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def init_worker(load_waveform):
+    global WORKER_LOAD_WAVEFORM
+    # the workers already use every core between them
+    torch.set_num_threads(1)
+    WORKER_LOAD_WAVEFORM = load_waveform
+
+def extract_worker(file_names, load_waveform=None):
+    """
+    Computes the MFCCs of a chunk of files. Runs in a worker process.
+
+    :param file_names: File names passed to load_waveform.
+    :param load_waveform: Function(file_name) returning the waveform of shape (channels, samples) and its sample rate, e.g. SegmentAudio.load_waveform. Defaults to the one the worker was started with.
+    :returns: List of float32 arrays of shape (frames, N_MFCC).
+    """
+    load_waveform = load_waveform or WORKER_LOAD_WAVEFORM
+    return [compute_mfcc(*load_waveform(file_name)).numpy().astype(np.float32) for file_name in file_names]
+
+
+class MFCCCache:
+    """
+    Cache of MFCC features on disk, holding the frames of every file in one memory-mapped float32 file and their positions in a JSON index.
+    Each entry records the content hash of the audio file it was computed from, and for virtual segments the boundaries within it. The hash is only recomputed when the file's size or modification time changed, so loading a cached dataset reads the index and the features and nothing else, while audio copied to another drive is still recognised by its content.
+    Entries replaced by new features leave unused frames in the features file; deleting the cache directory rebuilds it from scratch.
+    """
+    def __init__(self, path):
+        """
+        :param path: Cache directory, created if it does not exist. A cache written with other MFCC settings is discarded.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.entries = {}
+        self.features_filepath = os.path.join(path, FEATURES_FILE)
+        index_filepath = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_filepath):
+            with open(index_filepath, 'r') as f:
+                index = json.load(f)
+            if index['settings'] == mfcc_settings():
+                self.entries = index['entries']
+        if not self.entries and os.path.exists(self.features_filepath):
+            os.remove(self.features_filepath)
+        # file hashes computed during this run, shared by the virtual segments of one overlap file
+        self.hashes = {}
+
+    def content_hash(self, filepath, entry=None):
+        """
+        :param filepath: Path to an audio file.
+        :param entry: Cached entry computed from the same file, whose hash is reused if the file's size and modification time are unchanged.
+        :returns: Tuple of the content hash and the file's fingerprint.
+        """
+        fingerprint = file_fingerprint(filepath)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return entry['hash'], fingerprint
+        if filepath not in self.hashes:
+            self.hashes[filepath] = file_content_hash(filepath)
+        return self.hashes[filepath], fingerprint
+
+    def load(self, file_names, sources, load_waveform, workers=WORKERS):
+        """
+        Returns the MFCC features of each file, computing those missing from the cache or whose audio changed in a pool of worker processes.
+        Workers are forked and inherit load_waveform, so it may be defined in the notebook or be a bound method such as SegmentAudio.load_waveform, whose segment boundaries are then not copied to the workers with every chunk.
+
+        :param file_names: File names passed to load_waveform.
+        :param sources: For each file name, a tuple of the audio file it is read from, and the start and end in ms of a virtual segment within it (None for whole files).
+        :param load_waveform: Function(file_name) returning the waveform of shape (channels, samples) and its sample rate.
+        :param workers: Number of worker processes, 1 computes the features in this process.
+        :returns: List of tensors of shape (frames, N_MFCC).
+        """
+        file_names = list(file_names)
+        if not file_names:
+            return []
+        keys = {}
+        missing = []
+        for file_name, (filepath, start_ms, end_ms) in zip(file_names, sources):
+            if file_name in keys:
+                continue
+            entry = self.entries.get(file_name)
+            segment = [None, None] if start_ms is None else [float(start_ms), float(end_ms)]
+            content_hash, fingerprint = self.content_hash(filepath, entry)
+            keys[file_name] = {'hash': content_hash, 'fingerprint': fingerprint, 'segment': segment}
+            if entry is None or entry['hash'] != content_hash or entry['segment'] != segment:
+                missing.append(file_name)
+            elif entry['fingerprint'] != fingerprint:
+                entry['fingerprint'] = fingerprint
+
+        if missing:
+            print(f'Computing MFCC features of {len(missing)} of {len(keys)} files')
+            chunks = [missing[i:i + CHUNK_SIZE] for i in range(0, len(missing), CHUNK_SIZE)]
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=init_worker, initargs=(load_waveform,)) as executor:
+                    results = executor.map(extract_worker, chunks)
+                    self.append(chunks, results, keys)
+            else:
+                self.append(chunks, (extract_worker(chunk, load_waveform) for chunk in chunks), keys)
+        self.save_index()
+
+        features = np.memmap(self.features_filepath, dtype=np.float32, mode='r').reshape(-1, N_MFCC)
+        spans = [(self.entries[file_name]['offset'], self.entries[file_name]['frames']) for file_name in file_names]
+        return [torch.from_numpy(np.array(features[offset:offset + frames])) for offset, frames in spans]
+
+    def append(self, chunks, results, keys):
+        """
+        Appends computed features to the features file and records their entries.
+
+        :param chunks: Lists of file names, in the order of results.
+        :param results: Iterable of lists of feature arrays, one list per chunk.
+        :param keys: Dictionary mapping each file name to its hash, fingerprint and segment.
+        """
+        with open(self.features_filepath, 'ab') as f:
+            # a frame cut off by an interrupted run is dropped, its file is no longer in the index
+            offset = f.tell() // FRAME_BYTES
+            f.truncate(offset * FRAME_BYTES)
+            for chunk, chunk_features in zip(chunks, results):
+                for file_name, mfcc in zip(chunk, chunk_features):
+                    f.write(mfcc.tobytes())
+                    self.entries[file_name] = {**keys[file_name], 'offset': offset, 'frames': len(mfcc)}
+                    offset += len(mfcc)
+
+    def save_index(self):
+        """
+        Writes the index atomically, after the features it points to.
+        """
+        index_filepath = os.path.join(self.path, INDEX_FILE)
+        with open(index_filepath + '.tmp', 'w') as f:
+            json.dump({'settings': mfcc_settings(), 'entries': self.entries}, f)
+        os.replace(index_filepath + '.tmp', index_filepath)
@@ -0,0 +1,93 @@
+import torch
+from torch.utils.data import Sampler
+
+# shared by the pattern-based notebooks, which import it with sys.path.append('..')
+
+BUCKET_POOL_SIZE = 50 # batches sorted together, larger pools give less padding but less random batches
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping sequences of similar length, so that padding each batch only to its longest sequence wastes little compute.
+    Each epoch the indices are shuffled and split into pools of pool_size batches. Each pool is sorted by length and cut into batches, and the order of all batches is shuffled. Batches therefore stay random while the lengths within a batch are nearly uniform.
+    Passed to the DataLoader as batch_sampler, in place of batch_size and shuffle.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, pool_size=BUCKET_POOL_SIZE):
+        """
+        :param lengths: Number of frames of each data point, in dataset order.
+        :param batch_size: Number of data points per batch.
+        :param shuffle: If False, e.g. for validation, the whole dataset is sorted by length once and batches are returned in that order.
+        :param pool_size: Number of batches sorted together when shuffling.
+        """
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+
+    def __iter__(self):
+        if self.shuffle:
+            # drawn from torch's global generator, so torch.manual_seed(SEED) keeps runs reproducible
+            indices = torch.randperm(len(self.lengths)).tolist()
+            pool = self.batch_size * self.pool_size
+        else:
+            indices = list(range(len(self.lengths)))
+            pool = max(len(indices), 1)
+
+        batches = []
+        for start in range(0, len(indices), pool):
+            sorted_indices = sorted(indices[start:start + pool], key=self.lengths.__getitem__)
+            batches += [sorted_indices[i:i + self.batch_size] for i in range(0, len(sorted_indices), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        pool = self.batch_size * self.pool_size if self.shuffle else max(len(self.lengths), 1)
+        full_pools, remainder = divmod(len(self.lengths), pool)
+        return full_pools * -(-pool // self.batch_size) + -(-remainder // self.batch_size)
+
+
+def pad_batch(embeddings, max_length=None):
+    """
+    Zero-pads a batch of sequences into a single tensor allocated once, padding only to the longest sequence in the batch instead of a fixed length.
+
+    :param embeddings: List of tensors of shape (frames, dim).
+    :param max_length: Sequences longer than this are truncated, None keeps every frame.
+    :returns: Tuple of the padded tensor of shape (batch, longest sequence, dim) and a tensor with the number of frames of each sequence.
+    """
+    lengths = torch.tensor([len(embedding) if max_length is None else min(len(embedding), max_length) for embedding in embeddings], dtype=torch.long)
+    padded = torch.zeros((len(embeddings), int(lengths.max()), embeddings[0].shape[-1]), dtype=embeddings[0].dtype)
+    for i, (embedding, length) in enumerate(zip(embeddings, lengths.tolist())):
+        padded[i, :length] = embedding[:length]
+    return padded, lengths
+
+
+class TensorBatchLoader:
+    """
+    Iterates over batches of tensors held in memory whose first dimension indexes the data points, such as the pooled embedding matrices of the average-based models.
+    Each batch is gathered from the whole tensor with a single indexing operation, where a DataLoader over a Dataset fetches and collates data points one at a time.
+    """
+    def __init__(self, *tensors, batch_size=None, shuffle=False):
+        """
+        :param tensors: Tensors with the same number of rows, e.g. embeddings and labels.
+        :param batch_size: Number of data points per batch, None returns the whole dataset as a single batch.
+        :param shuffle: If True the data points are reshuffled every epoch.
+        """
+        if any(len(tensor) != len(tensors[0]) for tensor in tensors):
+            raise ValueError(f'Tensors of different lengths: {[len(tensor) for tensor in tensors]}')
+        self.tensors = tensors
+        self.batch_size = batch_size or max(len(tensors[0]), 1)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        num_rows = len(self.tensors[0])
+        # drawn from torch's global generator like DataLoader's shuffling, so torch.manual_seed(SEED) keeps runs reproducible
+        indices = torch.randperm(num_rows) if self.shuffle else None
+        for start in range(0, num_rows, self.batch_size):
+            if indices is None:
+                yield tuple(tensor[start:start + self.batch_size] for tensor in self.tensors)
+            else:
+                yield tuple(tensor[indices[start:start + self.batch_size]] for tensor in self.tensors)
+
+    def __len__(self):
+        return -(-len(self.tensors[0]) // self.batch_size)
@@ -0,0 +1,162 @@
+import os
+import json
+import math
+import hashlib
+import multiprocessing
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+
+# shared by the grid search notebooks, which import it with sys.path.append('..')
+
+MIN_EPOCHS = 5 # every configuration trains at least this long, and only validation F1 scores from this epoch onwards count
+MAX_EPOCHS = 20
+REDUCTION_FACTOR = 2 # each rung of successive halving keeps the best 1 / REDUCTION_FACTOR of the configurations and doubles their epochs
+RESULTS_FILE = 'results.jsonl'
+
+
+def parameter_combinations(param_grid):
+    """
+    :param param_grid: Dictionary mapping each hyperparameter to the list of values to try.
+    :returns: List of dictionaries, one per combination of values.
+    """
+    return [dict(zip(param_grid.keys(), values)) for values in product(*param_grid.values())]
+
+def configuration_id(params):
+    """
+    :param params: Dictionary of hyperparameters.
+    :returns: Short hash identifying the configuration in the results and checkpoint file names.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+def rung_epochs(min_epochs=MIN_EPOCHS, max_epochs=MAX_EPOCHS, reduction_factor=REDUCTION_FACTOR):
+    """
+    :returns: Total number of epochs trained by the end of each rung, e.g. [5, 10, 20].
+    """
+    epochs = [min_epochs]
+    while epochs[-1] < max_epochs:
+        epochs.append(min(epochs[-1] * reduction_factor, max_epochs))
+    return epochs
+
+def pack_shared(embeddings):
+    """
+    Moves a list of embedding tensors into a single block of shared memory, returning views into it. Processes forked by the grid search then read the same copy of the dataset rather than each duplicating the pages they touch.
+
+    :param embeddings: List of tensors of shape (frames, dim) or (dim,).
+    :returns: List of views of the same shapes.
+    """
+    shapes = [embedding.shape for embedding in embeddings]
+    flat = torch.cat([embedding.reshape(-1) for embedding in embeddings]).share_memory_()
+    return [view.view(shape) for view, shape in zip(torch.split(flat, [shape.numel() for shape in shapes]), shapes)]
+
+
+def read_results(directory):
+    """
+    :param directory: Grid search directory.
+    :returns: Dictionary mapping (configuration id, rung) to the record written when that rung finished.
+    """
+    records = {}
+    filepath = os.path.join(directory, RESULTS_FILE)
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as f:
+            for line in f:
+                # a line cut off by an interruption is ignored and its rung trained again
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[(record['id'], record['rung'])] = record
+    return records
+
+def train_rung(train_function, params, directory, rung, num_epochs, min_epochs=MIN_EPOCHS):
+    """
+    Trains one configuration up to the end of a rung, continuing from its checkpoint at the end of the previous rung. Runs in a worker process.
+    The weights with the best F1 score so far are saved with the checkpoint and copied to {id}.best.pth once the rung is finished, so they always belong to the F1 scores of the record.
+
+    :param train_function: Function(params, state, num_epochs, report) training for num_epochs more epochs and returning its new state. state is None for a new configuration, and otherwise whatever it returned for the previous rung (e.g. the model and optimiser state dicts). report(macro_f1, model) must be called after every epoch.
+    :param params: Dictionary of hyperparameters.
+    :param directory: Grid search directory.
+    :param rung: Index of the rung.
+    :param num_epochs: Total number of epochs by the end of the rung.
+    :param min_epochs: First epoch whose validation F1 score counts.
+    :returns: Record of the configuration at the end of the rung.
+    """
+    identifier = configuration_id(params)
+    checkpoint_filepath = os.path.join(directory, f'{identifier}.checkpoint.pth')
+    best_filepath = os.path.join(directory, f'{identifier}.best.pth')
+    # a checkpoint already at or past the end of this rung (interrupted before its result was written) trains for no further epochs
+    checkpoint = torch.load(checkpoint_filepath) if os.path.exists(checkpoint_filepath) else {'state': None, 'f1_scores': []}
+    f1_scores = checkpoint['f1_scores']
+    best_f1 = max(f1_scores[min_epochs - 1:], default=-1)
+    # the best weights are kept in memory and saved with the checkpoint, so best.pth never holds weights of an interrupted run the F1 scores do not cover
+    best_weights = checkpoint.get('best_weights')
+
+    def report(macro_f1, model):
+        nonlocal best_f1, best_weights
+        f1_scores.append(macro_f1)
+        if len(f1_scores) >= min_epochs and macro_f1 > best_f1:
+            best_f1 = macro_f1
+            best_weights = {name: tensor.detach().cpu().clone() for name, tensor in model.state_dict().items()}
+
+    state = train_function(params, checkpoint['state'], num_epochs - len(f1_scores), report)
+    torch.save({'state': state, 'f1_scores': f1_scores, 'best_weights': best_weights}, checkpoint_filepath + '.tmp')
+    os.replace(checkpoint_filepath + '.tmp', checkpoint_filepath)
+    # written from the checkpoint at the end of every rung, including one that trained no further epochs after an interruption
+    if best_weights is not None:
+        torch.save(best_weights, best_filepath + '.tmp')
+        os.replace(best_filepath + '.tmp', best_filepath)
+    # the record covers only the epochs of this rung, so configurations are ranked on equal terms
+    f1_scores = f1_scores[:num_epochs]
+    return {'id': identifier, 'params': params, 'rung': rung, 'epochs': len(f1_scores), 'f1_scores': f1_scores, 'score': max(f1_scores[min_epochs - 1:], default=-1)}
+
+def set_worker_threads(num_threads):
+    torch.set_num_threads(num_threads)
+
+def grid_search(param_grid, train_function, directory, workers=1, min_epochs=MIN_EPOCHS, max_epochs=MAX_EPOCHS, reduction_factor=REDUCTION_FACTOR):
+    """
+    Grid search with successive halving. Every configuration first trains for min_epochs epochs. The best 1 / reduction_factor of them, by their highest validation macro average F1 score, train on for reduction_factor times as many epochs, and so on until max_epochs; poor configurations are thereby dropped early instead of training for the full epoch count.
+    Configurations of a rung are trained in parallel by worker processes forked from the caller, so the datasets the notebook prepared (see pack_shared) and its train_function are shared with the workers rather than loaded again. CUDA must not be initialised before forking.
+    Each configuration's checkpoint and weights with the best F1 score are saved in directory, and a line is added to results.jsonl when it finishes a rung. Calling grid_search again with the same directory resumes an interrupted search, skipping every rung already finished.
+
+    :param param_grid: Dictionary mapping each hyperparameter to the list of values to try.
+    :param train_function: See train_rung.
+    :param directory: Grid search directory, created if it does not exist.
+    :param workers: Number of configurations trained at once. The CPU threads are split between them.
+    :param min_epochs: Epochs of the first rung.
+    :param max_epochs: Epochs of the last rung.
+    :param reduction_factor: Fraction of configurations dropped at each rung, and factor by which the epochs of the next grow.
+    :returns: Tuple of the best parameters, their highest macro average F1 score and the path of their best weights.
+    """
+    os.makedirs(directory, exist_ok=True)
+    records = read_results(directory)
+    configurations = parameter_combinations(param_grid)
+    num_threads = max(1, torch.get_num_threads() // workers)
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=set_worker_threads, initargs=(num_threads,))
+
+    try:
+        for rung, num_epochs in enumerate(rung_epochs(min_epochs, max_epochs, reduction_factor)):
+            if rung > 0:
+                previous = sorted(configurations, key=lambda params: records[(configuration_id(params), rung - 1)]['score'], reverse=True)
+                configurations = previous[:math.ceil(len(previous) / reduction_factor)]
+            pending = [params for params in configurations if (configuration_id(params), rung) not in records]
+            print(f'Rung {rung + 1}: {len(configurations)} configurations to {num_epochs} epochs, {len(configurations) - len(pending)} already trained')
+
+            if executor is None:
+                results = (train_rung(train_function, params, directory, rung, num_epochs, min_epochs) for params in pending)
+            else:
+                futures = [executor.submit(train_rung, train_function, params, directory, rung, num_epochs, min_epochs) for params in pending]
+                results = (future.result() for future in as_completed(futures))
+            for record in results:
+                records[(record['id'], rung)] = record
+                with open(os.path.join(directory, RESULTS_FILE), 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                print(f"Finished {record['params']} after {record['epochs']} epochs, highest macro average F1 score: {record['score']:.4f}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    best = max(configurations, key=lambda params: records[(configuration_id(params), rung)]['score'])
+    best_id = configuration_id(best)
+    return best, records[(best_id, rung)]['score'], os.path.join(directory, f'{best_id}.best.pth')
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from models import TCN, AudioModel, Classifier, FIXED_LENGTH, fold_weight_norm, set_causal_normalisation, load_tcn_settings
+
+sys.path.append('../../Dataset')
+
+#### Edit variables and filepaths here ####
+WEIGHTS_DIRECTORY = './drive/MyDrive/Thesis/weights-and-graphs/'
+BATCH_SIZES = [1, 8, 32]
+THREAD_COUNTS = [1, 2, 4]
+NUM_BATCHES = 20 # timed batches per configuration
+WARMUP_BATCHES = 3 # untimed batches run first, so one-off allocations are not counted
+NUM_SAMPLES = 256 # samples the batches are drawn from
+MAX_SEGMENTS = 16 # random samples span 1 to MAX_SEGMENTS segments of 300 ms, like the prefixes of the test set
+PERCENTILES = [50, 95, 99]
+
+# for each model family: the constructor, input features per frame, frames per 300 ms segment and the weights under WEIGHTS_DIRECTORY, see the test notebooks
+# HuBERT emits a frame every 20 ms and the VAD's MFCC transform every 10 ms
+MODELS = {
+    'vad': (lambda: Classifier(13, 64, 1, 1, True, 0), 13, 30, 'baseline-vad/model.pth'),
+    'average': (lambda: AudioModel(768, [256]), 768, 15, 'average/model.pth'),
+    'lstm': (lambda: Classifier(768, 256, 1, 2, True, 0), 768, 15, 'lstm-base/model.pth'),
+    'lstm-large': (lambda: Classifier(768, 768, 1, 4, True, 0), 768, 15, 'lstm-large/model.pth'), # LARGE_LSTM, see train_LSTM_model.ipynb
+    'tcn': (lambda: TCN(768, [1024, 768, 384], kernel_size=2, dropout=0), 768, 15, 'tcn-base/model.pth'),
+}
+
+
+def load_model(name, weights_directory=WEIGHTS_DIRECTORY, models=MODELS):
+    """
+    Builds a model family in evaluation mode, loading its saved weights if they exist.
+
+    :param name: Key of models.
+    :param weights_directory: Directory holding the weights of every model family.
+    :param models: Dictionary of model families in the form of MODELS, e.g. export.py's, which adds the multimodal model.
+    :returns: Tuple of the model and the path of the weights loaded, or None if the model is randomly initialised.
+    """
+    build, _, _, weights = models[name]
+    model = build()
+    weights_path = os.path.join(weights_directory, weights)
+    if not os.path.exists(weights_path):
+        weights_path = None
+    else:
+        model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
+    model.eval()
+    if name == 'tcn':
+        if weights_path is not None:
+            set_causal_normalisation(model, load_tcn_settings(weights_path)['causal_normalisation'])
+        fold_weight_norm(model)
+    return model, weights_path
+
+def load_samples(name, num_samples=NUM_SAMPLES, store=None, seed=0):
+    """
+    Samples in the form the test notebooks hold them before batching, one tensor of shape (frames, features) each.
+
+    :param name: Key of MODELS.
+    :param num_samples: Number of samples.
+    :param store: Optional embedding store directory to read HuBERT embeddings from. The VAD's MFCC features are not stored and are always random.
+    :param seed: Seed for the random samples.
+    :returns: Tuple of the list of samples and a description of where they come from.
+    """
+    _, features, frames_per_segment, _ = MODELS[name]
+    if store is not None and name != 'vad':
+        from embedding_store import EmbeddingStore
+        column = EmbeddingStore(store, ['hubert_embeddings'])['hubert_embeddings']
+        rows = np.random.default_rng(seed).choice(len(column), size=min(num_samples, len(column)), replace=False)
+        return [torch.tensor(np.array(column[row]), dtype=torch.float32) for row in rows], store
+    generator = torch.Generator().manual_seed(seed)
+    segments = torch.randint(1, MAX_SEGMENTS + 1, (num_samples,), generator=generator)
+    return [torch.randn((int(n) * frames_per_segment, features), generator=generator) for n in segments], 'random'
+
+def predict(name, model, samples):
+    """
+    Batches samples as the test notebooks' collate functions do and runs the model on them.
+
+    :param name: Key of MODELS.
+    :param model: Model in evaluation mode.
+    :param samples: List of tensors of shape (frames, features).
+    :returns: Tensor of predicted probabilities.
+    """
+    if name == 'average':
+        output = model(torch.stack([sample.mean(0) for sample in samples]))
+    elif name == 'tcn':
+        # truncate or zero-pad to the fixed length the TCN was trained on
+        batch = torch.zeros((len(samples), FIXED_LENGTH, samples[0].shape[1]))
+        for i, sample in enumerate(samples):
+            batch[i, :min(len(sample), FIXED_LENGTH)] = sample[:FIXED_LENGTH]
+        output = model(batch)
+    else:
+        output = model(pad_sequence(samples, batch_first=True), [len(sample) for sample in samples])
+    return torch.sigmoid(output.squeeze(1))
+
+def peak_rss_mb():
+    """
+    :returns: Peak resident set size of this process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+def run_configuration(name, threads, batch_size, num_batches=NUM_BATCHES, warmup_batches=WARMUP_BATCHES, weights_directory=WEIGHTS_DIRECTORY, store=None, seed=0):
+    """
+    Times one model family at one thread count and batch size. Each timed batch covers batching the stored samples, the forward pass and the sigmoid, so the numbers include the data handling the test notebooks excluded.
+    Meant to run in a fresh process (see benchmark), so that the peak memory is that of this configuration alone.
+
+    :param name: Key of MODELS.
+    :param threads: Number of CPU threads torch may use.
+    :param batch_size: Samples per batch.
+    :param num_batches: Timed batches.
+    :param warmup_batches: Untimed batches run first.
+    :param weights_directory: Directory holding the weights of every model family.
+    :param store: Optional embedding store to read samples from.
+    :param seed: Seed for the samples and the order they are batched in.
+    :returns: Dictionary of results, see benchmark.
+    """
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    model, weights_path = load_model(name, weights_directory)
+    samples, inputs = load_samples(name, max(NUM_SAMPLES, batch_size), store, seed)
+    order = np.random.default_rng(seed).permutation(len(samples))
+
+    latencies = []
+    with torch.inference_mode():
+        for i in range(warmup_batches + num_batches):
+            start = i * batch_size % len(samples)
+            batch = [samples[j] for j in np.roll(order, -start)[:batch_size]]
+            start_time = time.perf_counter()
+            predict(name, model, batch)
+            if i >= warmup_batches:
+                latencies.append(time.perf_counter() - start_time)
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'model': name,
+        'weights': weights_path,
+        'inputs': inputs,
+        'threads': threads,
+        'batch_size': batch_size,
+        'batches': num_batches,
+        'latency_ms': {**{f'p{p}': float(np.percentile(latencies_ms, p)) for p in PERCENTILES}, 'mean': float(latencies_ms.mean())},
+        'throughput': batch_size * num_batches / float(np.sum(latencies)), # samples per second
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def benchmark(names, batch_sizes=BATCH_SIZES, thread_counts=THREAD_COUNTS, **kwargs):
+    """
+    Sweeps every model family over batch sizes and thread counts. Each configuration runs in a freshly spawned process, so the models do not share memory or warmed-up state.
+
+    :param names: Keys of MODELS.
+    :param batch_sizes: Batch sizes to sweep.
+    :param thread_counts: Thread counts to sweep.
+    :param kwargs: Passed on to run_configuration.
+    :returns: Dictionary describing the environment and listing the results of each configuration: latency percentiles per batch in milliseconds, throughput in samples per second and peak resident memory in MB.
+    """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name in names:
+        for threads in thread_counts:
+            for batch_size in batch_sizes:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_configuration, name, threads, batch_size, **kwargs).result()
+                results.append(result)
+                latency = result['latency_ms']
+                print(f"{name:>10} threads {threads} batch {batch_size:>3}: p50 {latency['p50']:.2f} ms, p95 {latency['p95']:.2f} ms, p99 {latency['p99']:.2f} ms, {result['throughput']:.1f} samples/s, peak RSS {result['peak_rss_mb']:.0f} MB", file=sys.stderr)
+    return {
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'settings': {key: value for key, value in kwargs.items()},
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark CPU inference of the VAD, Average-based, LSTM and TCN models, writing the results as JSON.')
+    parser.add_argument('--models', default=','.join(MODELS), help=f'comma separated model families from {", ".join(MODELS)}')
+    parser.add_argument('--weights-dir', default=WEIGHTS_DIRECTORY, help='directory of saved weights, models without weights are randomly initialised')
+    parser.add_argument('--batch-sizes', default=','.join(map(str, BATCH_SIZES)), help='comma separated batch sizes')
+    parser.add_argument('--threads', default=','.join(map(str, THREAD_COUNTS)), help='comma separated thread counts')
+    parser.add_argument('--batches', type=int, default=NUM_BATCHES, help='timed batches per configuration')
+    parser.add_argument('--warmup', type=int, default=WARMUP_BATCHES, help='untimed batches per configuration')
+    parser.add_argument('--store', default=None, help='embedding store to read HuBERT embeddings from, random samples if not given')
+    parser.add_argument('--output', default=None, help='JSON file to write, printed if not given')
+    args = parser.parse_args()
+
+    names = args.models.split(',')
+    unknown = [name for name in names if name not in MODELS]
+    if unknown:
+        parser.error(f'unknown models {unknown}')
+    report = benchmark(names, [int(size) for size in args.batch_sizes.split(',')], [int(threads) for threads in args.threads.split(',')],
+                       num_batches=args.batches, warmup_batches=args.warmup, weights_directory=args.weights_dir, store=args.store)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output + '.tmp', 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(args.output + '.tmp', args.output)
@@ -0,0 +1,350 @@
+import time
+import socket
+import argparse
+from collections import namedtuple
+import numpy as np
+import soundfile as sf
+import torch
+from transformers import Wav2Vec2Processor, HubertModel
+from models import TCN, AudioModel, FIXED_LENGTH, fold_weight_norm, set_causal_normalisation, load_tcn_settings
+from stateful_tcn import StatefulTCN
+
+#### Edit variables and filepaths here ####
+SAMPLE_RATE = 16_000
+DECISION_MS = 300 # a decision is emitted for every 300 ms of audio, matching the segments of create_dataset(300, 1)
+CHUNK_MS = 100 # size of the chunks read from a file, a live feed may deliver chunks of any size
+CONTEXT_MS = 500 # audio preceding each new 300 ms that is re-run through HuBERT so the new frames have left context
+MAX_FRAMES = FIXED_LENGTH # frames kept in the rolling cache, 5 s of audio at one HuBERT frame per 20 ms
+TRUE_THRESHOLD = 0.5
+NUM_THREADS = 1 # the detector must keep up with real time on a single CPU core
+DEFAULT_PORT = 5005
+
+HUBERT_PROCESSOR = "facebook/wav2vec2-base"
+HUBERT_MODEL = "facebook/hubert-base-ls960"
+CLASSIFIERS = ('tcn', 'stateful-tcn', 'average') # stateful-tcn updates the TCN frame by frame and needs weights trained with CAUSAL_NORMALISATION, see stateful_tcn.py
+TCN_WEIGHTS_PATH = './drive/MyDrive/Thesis/weights-and-graphs/tcn-base/model.pth'
+TCN_LAYERS = [1024, 768, 384] # optimal configuration, see test_TCN_model.ipynb
+AVERAGE_WEIGHTS_PATH = './drive/MyDrive/Thesis/weights-and-graphs/average/model.pth'
+AVERAGE_HIDDEN_LAYERS = [256] # MODEL_SIZE = 1, see test_average_audio_model.ipynb
+
+# HuBERT's feature encoder emits one frame per 320 samples (20 ms) once it has seen its 400 sample receptive field
+FRAME_STRIDE = 320
+
+Decision = namedtuple('Decision', ['time_ms', 'probability', 'interruption'])
+
+
+def pcm16_to_float(data):
+    """
+    :param data: Bytes of 16-bit little-endian mono PCM.
+    :returns: Float32 numpy array in [-1, 1].
+    """
+    return np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768
+
+def float_to_pcm16(samples):
+    """
+    :param samples: Float numpy array in [-1, 1].
+    :returns: Bytes of 16-bit little-endian mono PCM.
+    """
+    return (np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes()
+
+def file_chunks(filepath, chunk_ms=CHUNK_MS, realtime=False):
+    """
+    Reads a 16 kHz WAV file in chunks, standing in for a live audio feed.
+
+    :param filepath: Path to the WAV file, stereo files are converted to mono.
+    :param chunk_ms: Length of each chunk in milliseconds.
+    :param realtime: If True, each chunk is only yielded once it would have been fully recorded.
+    :returns: Generator of float32 numpy arrays.
+    """
+    if sf.info(filepath).samplerate != SAMPLE_RATE:
+        raise ValueError(f'{filepath} must be sampled at {SAMPLE_RATE} Hz')
+    chunk_size = SAMPLE_RATE * chunk_ms // 1000
+    start_time = time.perf_counter()
+    received = 0
+    for chunk in sf.blocks(filepath, blocksize=chunk_size, dtype='float32', always_2d=True):
+        received += len(chunk)
+        if realtime:
+            time.sleep(max(0, start_time + received / SAMPLE_RATE - time.perf_counter()))
+        yield chunk.mean(axis=1)
+
+def socket_chunks(port=DEFAULT_PORT, chunk_ms=CHUNK_MS, host='127.0.0.1'):
+    """
+    Listens on a local TCP socket and yields the 16-bit PCM received from the first connection, a stand-in for a live audio feed.
+
+    :param port: Port to listen on.
+    :param chunk_ms: Length of each yielded chunk in milliseconds, the last chunk may be shorter.
+    :param host: Address to listen on.
+    :returns: Generator of float32 numpy arrays.
+    """
+    chunk_bytes = SAMPLE_RATE * chunk_ms // 1000 * 2
+    with socket.create_server((host, port)) as server:
+        print(f'Listening for 16 kHz 16-bit PCM on {host}:{port}')
+        connection, _ = server.accept()
+        with connection:
+            buffer = bytearray()
+            while True:
+                data = connection.recv(1 << 16)
+                if not data:
+                    break
+                buffer.extend(data)
+                while len(buffer) >= chunk_bytes:
+                    yield pcm16_to_float(bytes(buffer[:chunk_bytes]))
+                    del buffer[:chunk_bytes]
+            remaining = len(buffer) - len(buffer) % 2
+            if remaining:
+                yield pcm16_to_float(bytes(buffer[:remaining]))
+
+def send_file(filepath, port=DEFAULT_PORT, host='127.0.0.1', chunk_ms=20):
+    """
+    Streams a WAV file to a listening detector as 16-bit PCM at real-time pace, emulating a microphone.
+
+    :param filepath: Path to the 16 kHz WAV file.
+    :param port: Port the detector listens on.
+    :param host: Address the detector listens on.
+    :param chunk_ms: Length of each packet in milliseconds.
+    """
+    with socket.create_connection((host, port)) as connection:
+        for chunk in file_chunks(filepath, chunk_ms, realtime=True):
+            connection.sendall(float_to_pcm16(chunk))
+
+
+class FrameCache:
+    """
+    Rolling cache of the most recent HuBERT frames. Frames are appended to a preallocated buffer twice the cache size and the newest frames are only moved back to its start when it fills, so appending costs O(1) amortised and the cached frames are always one contiguous view.
+    """
+    def __init__(self, max_frames, dim):
+        """
+        :param max_frames: Number of frames kept.
+        :param dim: Size of each frame.
+        """
+        self.max_frames = max_frames
+        self.buffer = torch.zeros((2 * max_frames, dim))
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, frames):
+        """
+        :param frames: Tensor of shape (frames, dim).
+        """
+        frames = frames[-self.max_frames:]
+        if self.end + len(frames) > len(self.buffer):
+            keep = min(len(self), self.max_frames - len(frames))
+            self.buffer[:keep] = self.buffer[self.end - keep:self.end].clone()
+            self.start, self.end = 0, keep
+        self.buffer[self.end:self.end + len(frames)] = frames
+        self.end += len(frames)
+        self.start = max(self.start, self.end - self.max_frames)
+
+    def view(self):
+        """
+        :returns: Tensor of shape (frames, dim) holding the cached frames, oldest first.
+        """
+        return self.buffer[self.start:self.end]
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+
+class StreamingDetector:
+    """
+    Classifies a live 16 kHz audio feed as interruption or non-interruption every DECISION_MS.
+    Each time a further 300 ms has arrived, HuBERT is run over those samples plus CONTEXT_MS of the audio before them, and only the frames of the new audio are added to a rolling frame cache. HuBERT therefore costs the same for every decision instead of growing with the length of the overlap. The new frames see CONTEXT_MS of left context rather than the whole prefix, so they differ slightly from the offline embeddings.
+    The classifiers were trained on prefixes starting at the onset of overlapped speech, reset() should be called at that onset to classify the overlap rather than the last MAX_FRAMES of audio.
+    """
+    def __init__(self, processor, hubert, classifier, classifier_type, decision_ms=DECISION_MS, context_ms=CONTEXT_MS, max_frames=MAX_FRAMES, threshold=TRUE_THRESHOLD):
+        """
+        :param processor: The processor, for HuBERT we use wav2vec's processor.
+        :param hubert: Pre-trained HuBERT model, in evaluation mode.
+        :param classifier: Trained TCN or AudioModel, in evaluation mode.
+        :param classifier_type: 'tcn', 'stateful-tcn' or 'average'.
+        :param decision_ms: Milliseconds of audio between decisions.
+        :param context_ms: Milliseconds of left context re-run through HuBERT with each new segment.
+        :param max_frames: Number of HuBERT frames kept in the rolling cache.
+        :param threshold: Probability above which a decision is an interruption.
+        """
+        if classifier_type not in CLASSIFIERS:
+            raise ValueError(f'Invalid classifier: {classifier_type}')
+        self.processor = processor
+        self.hubert = hubert
+        self.classifier = classifier
+        self.classifier_type = classifier_type
+        self.decision_samples = SAMPLE_RATE * decision_ms // 1000
+        self.context_samples = SAMPLE_RATE * context_ms // 1000
+        self.threshold = threshold
+        self.cache = FrameCache(max_frames, hubert.config.hidden_size)
+        # the TCN expects FIXED_LENGTH frames, zero-padded at the end as in collate_fn
+        self.tcn_input = torch.zeros((1, FIXED_LENGTH, hubert.config.hidden_size))
+        self.stateful_tcn = StatefulTCN(classifier) if classifier_type == 'stateful-tcn' else None
+        self.logit = None # latest output of the stateful TCN
+        self.audio = np.zeros(0, dtype=np.float32) # audio from audio_start onwards, always starting on a frame boundary
+        self.audio_start = 0
+        self.num_samples = 0 # samples received so far
+        self.num_frames = 0 # HuBERT frames computed so far
+        self.next_decision = self.decision_samples
+
+    def reset(self):
+        """
+        Starts classifying afresh, e.g. at the onset of overlapped speech. The audio context is kept for HuBERT.
+        """
+        self.cache.reset()
+        if self.stateful_tcn is not None:
+            self.stateful_tcn.reset()
+            self.logit = None
+        self.next_decision = self.num_samples + self.decision_samples
+
+    def push(self, chunk):
+        """
+        Adds a chunk of audio and emits a decision for every DECISION_MS boundary it completes.
+
+        :param chunk: Float32 numpy array of 16 kHz mono samples.
+        :returns: List of Decision tuples, empty if no decision boundary was reached.
+        """
+        decisions = []
+        offset = 0
+        while offset < len(chunk):
+            take = min(len(chunk) - offset, self.next_decision - self.num_samples)
+            self.audio = np.concatenate([self.audio, chunk[offset:offset + take]])
+            self.num_samples += take
+            offset += take
+            if self.num_samples == self.next_decision:
+                self.update_frames()
+                decisions.append(self.decide())
+                self.next_decision += self.decision_samples
+        return decisions
+
+    def update_frames(self):
+        """
+        Runs HuBERT over the buffered audio and appends the frames not computed before to the cache.
+        """
+        expected = self.hubert._get_feat_extract_output_lengths(torch.tensor(self.num_samples)).item() if self.num_samples >= 400 else 0
+        if expected > self.num_frames:
+            with torch.inference_mode():
+                input_values = self.processor(self.audio, return_tensors="pt", sampling_rate=SAMPLE_RATE).input_values
+                hidden_states = self.hubert(input_values).last_hidden_state[0]
+            # frame i of the window is global frame audio_start / FRAME_STRIDE + i
+            first = self.num_frames - self.audio_start // FRAME_STRIDE
+            new_frames = hidden_states[first:first + expected - self.num_frames]
+            self.cache.append(new_frames)
+            if self.stateful_tcn is not None:
+                self.logit = self.stateful_tcn.step_frames(new_frames)
+            self.num_frames = expected
+        # keep only the context needed by the next window
+        keep_from = max(0, self.num_samples - self.context_samples) // FRAME_STRIDE * FRAME_STRIDE
+        self.audio = self.audio[keep_from - self.audio_start:]
+        self.audio_start = keep_from
+
+    def decide(self):
+        """
+        Classifies the cached frames.
+
+        :returns: Decision at the current position of the feed.
+        """
+        frames = self.cache.view()
+        with torch.inference_mode():
+            if len(frames) == 0:
+                probability = 0.0
+            elif self.classifier_type == 'stateful-tcn':
+                probability = torch.sigmoid(torch.tensor(self.logit)).item()
+            elif self.classifier_type == 'tcn':
+                self.tcn_input.zero_()
+                self.tcn_input[0, :len(frames)] = frames
+                probability = torch.sigmoid(self.classifier(self.tcn_input)).item()
+            else:
+                probability = torch.sigmoid(self.classifier(frames.mean(dim=0, keepdim=True))).item()
+        return Decision(self.num_samples * 1000 // SAMPLE_RATE, probability, probability >= self.threshold)
+
+
+def load_detector(classifier_type, weights_path=None, device=torch.device('cpu')):
+    """
+    Loads HuBERT and a trained classifier and creates a detector.
+
+    :param classifier_type: 'tcn', 'stateful-tcn' or 'average'.
+    :param weights_path: Path to the classifier's saved state dict, defaults to the path used by the test notebooks.
+    :param device: Device the classifier weights are mapped to.
+    :returns: StreamingDetector.
+    :raises ValueError: If 'stateful-tcn' is requested for weights not trained with causal normalisation, whose output it cannot reproduce.
+    """
+    is_tcn = classifier_type in ('tcn', 'stateful-tcn')
+    weights_path = weights_path or (TCN_WEIGHTS_PATH if is_tcn else AVERAGE_WEIGHTS_PATH)
+    causal = is_tcn and load_tcn_settings(weights_path)['causal_normalisation']
+    if classifier_type == 'stateful-tcn' and not causal:
+        raise ValueError(f'{weights_path} was not trained with CAUSAL_NORMALISATION, use --classifier tcn')
+    processor = Wav2Vec2Processor.from_pretrained(HUBERT_PROCESSOR)
+    hubert = HubertModel.from_pretrained(HUBERT_MODEL).eval()
+    if is_tcn:
+        classifier = TCN(hubert.config.hidden_size, TCN_LAYERS, kernel_size=2, dropout=0)
+    else:
+        classifier = AudioModel(hubert.config.hidden_size, AVERAGE_HIDDEN_LAYERS)
+    classifier.load_state_dict(torch.load(weights_path, map_location=device))
+    classifier.eval()
+    if is_tcn:
+        # the TCN normalises as it was trained, which the 'tcn' decisions then reproduce as well
+        set_causal_normalisation(classifier, causal)
+        fold_weight_norm(classifier)
+    return StreamingDetector(processor, hubert, classifier, classifier_type)
+
+def run_detector(detector, chunks, verbose=True):
+    """
+    Feeds a stream of chunks through the detector, printing each decision and a latency report at the end.
+
+    :param detector: StreamingDetector.
+    :param chunks: Iterable of float32 numpy arrays of 16 kHz audio.
+    :param verbose: If True, every decision is printed.
+    :returns: Tuple of the decisions and the processing latency of each chunk in seconds.
+    """
+    decisions = []
+    latencies = []
+    num_samples = 0
+    for chunk in chunks:
+        start_time = time.perf_counter()
+        chunk_decisions = detector.push(chunk)
+        latencies.append(time.perf_counter() - start_time)
+        num_samples += len(chunk)
+        for decision in chunk_decisions:
+            if verbose:
+                print(f"{decision.time_ms / 1000:8.1f}s  {decision.probability:.3f}  {'interruption' if decision.interruption else 'non-interruption'}")
+        decisions.extend(chunk_decisions)
+    report_latency(latencies, num_samples / SAMPLE_RATE)
+    return decisions, latencies
+
+def report_latency(latencies, audio_seconds):
+    """
+    Prints the per-chunk processing latency and whether the detector keeps up with real time.
+
+    :param latencies: Processing latency of each chunk in seconds.
+    :param audio_seconds: Duration of the audio processed.
+    """
+    if not latencies:
+        return
+    latencies_ms = np.array(latencies) * 1000
+    real_time_factor = sum(latencies) / audio_seconds if audio_seconds else float('inf')
+    print(f'{len(latencies)} chunks, latency per chunk: p50 {np.percentile(latencies_ms, 50):.1f} ms, p95 {np.percentile(latencies_ms, 95):.1f} ms, max {latencies_ms.max():.1f} ms')
+    # audio arriving while a decision is computed is buffered, so real time is sustained as long as each decision step finishes before the next one is due
+    sustained = real_time_factor < 1 and np.percentile(latencies_ms, 95) < DECISION_MS
+    print(f"Real-time factor {real_time_factor:.3f} on {torch.get_num_threads()} thread(s): {'sustains' if sustained else 'does not sustain'} real time")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detect interruptions in a live 16 kHz audio feed.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help='16 kHz WAV file to stream through the detector')
+    source.add_argument('--listen', type=int, metavar='PORT', help='listen for 16-bit PCM on a local socket')
+    source.add_argument('--send', help='stream a 16 kHz WAV file to a detector listening on --port, in real time')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port used with --send')
+    parser.add_argument('--classifier', choices=CLASSIFIERS, default='tcn', help='classifier making the decisions')
+    parser.add_argument('--weights', default=None, help="path to the classifier's weights")
+    parser.add_argument('--realtime', action='store_true', help='pace --file at real time rather than as fast as possible')
+    parser.add_argument('--threads', type=int, default=NUM_THREADS, help='number of CPU threads')
+    args = parser.parse_args()
+
+    if args.send:
+        send_file(args.send, args.port)
+    else:
+        torch.set_num_threads(args.threads)
+        detector = load_detector(args.classifier, args.weights)
+        chunks = file_chunks(args.file, realtime=args.realtime) if args.file else socket_chunks(args.listen)
+        run_detector(detector, chunks)
@@ -0,0 +1,245 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from torch import nn
+from torch.nn.utils.rnn import pad_sequence
+from sklearn.metrics import f1_score
+import benchmark
+from models import CustomModel, FIXED_LENGTH
+
+sys.path.append('../../Dataset')
+
+#### Edit variables and filepaths here ####
+WEIGHTS_DIRECTORY = benchmark.WEIGHTS_DIRECTORY
+EXPORT_DIRECTORY = './drive/MyDrive/Thesis/weights-and-graphs/exported/'
+QUANTIZED_MODULES = {nn.Linear, nn.LSTM} # layers stored as int8 by dynamic quantization, the TCN's convolutions stay float
+NUM_SAMPLES = 256 # decisions the eager and exported models are compared on
+TRUE_THRESHOLD = 0.5
+PERCENTILES = [50, 95, 99]
+BERT_EMBEDDING_DIM = 768
+
+# the benchmarked model families plus the multimodal model (MODEL_SIZE = 3, see test_average_multimodal_model.ipynb), which also takes the BERT context embedding
+MODELS = {**benchmark.MODELS, 'multimodal': (lambda: CustomModel(BERT_EMBEDDING_DIM, 768, [768, 512, 256]), 768, 15, 'average-bert-frozen/model.pth')}
+# inputs of each exported model, saved inside it so that callers need neither this file nor the notebooks
+INPUTS = {
+    'vad': ['mfcc (batch, frames, 13), zero-padded', 'lengths (batch,), int64'],
+    'average': ['mean pooled hubert (batch, 768)'],
+    'multimodal': ['bert (batch, 768)', 'mean pooled hubert (batch, 768)'],
+    'lstm': ['hubert (batch, frames, 768), zero-padded', 'lengths (batch,), int64'],
+    'lstm-large': ['hubert (batch, frames, 768), zero-padded', 'lengths (batch,), int64'],
+    'tcn': [f'hubert (batch, {FIXED_LENGTH}, 768), truncated or zero-padded to {FIXED_LENGTH} frames'],
+}
+CONFIG_FILE = 'config.json'
+
+
+def strip_dropout(model):
+    """
+    Replaces every dropout layer with the identity, which is all dropout computes in evaluation mode. TorchScript cannot compile the Classifier's nn.Dropout(0), whose rate is an int.
+
+    :param model: Model, modified in place.
+    :returns: The same model.
+    """
+    for module in list(model.modules()):
+        # _modules rather than named_children, which skips a layer listed twice like the dropout of the TCN's ResidualBlock.net
+        for child_name, child in list(module._modules.items()):
+            if isinstance(child, nn.Dropout):
+                setattr(module, child_name, nn.Identity())
+    return model
+
+def batch_inputs(name, samples, bert):
+    """
+    Batches samples into the inputs of a model family, see INPUTS.
+
+    :param name: Key of MODELS.
+    :param samples: List of tensors of shape (frames, features).
+    :param bert: Tensor of shape (len(samples), 768) with the BERT context embeddings, only used by the multimodal model.
+    :returns: Tuple of input tensors.
+    """
+    if name == 'average':
+        return (torch.stack([sample.mean(0) for sample in samples]),)
+    if name == 'multimodal':
+        return bert, torch.stack([sample.mean(0) for sample in samples])
+    if name == 'tcn':
+        batch = torch.zeros((len(samples), FIXED_LENGTH, samples[0].shape[1]))
+        for i, sample in enumerate(samples):
+            batch[i, :min(len(sample), FIXED_LENGTH)] = sample[:FIXED_LENGTH]
+        return (batch,)
+    return pad_sequence(samples, batch_first=True), torch.tensor([len(sample) for sample in samples], dtype=torch.long)
+
+def load_test_set(name, store=None, num_samples=NUM_SAMPLES, seed=0):
+    """
+    :param name: Key of MODELS.
+    :param store: Optional test embedding store to read HuBERT and BERT embeddings and labels from. The VAD's MFCC features are not stored and are always random.
+    :param num_samples: Number of samples.
+    :param seed: Seed for the choice of samples.
+    :returns: Tuple of the list of samples of shape (frames, features), a tensor of BERT embeddings, the labels (None for random samples) and a description of where they come from.
+    """
+    if store is None or name == 'vad':
+        samples, inputs = benchmark.load_samples('average' if name == 'multimodal' else name, num_samples, seed=seed)
+        bert = torch.randn((len(samples), BERT_EMBEDDING_DIM), generator=torch.Generator().manual_seed(seed))
+        return samples, bert, None, inputs
+
+    from embedding_store import EmbeddingStore
+    test_store = EmbeddingStore(store, ['hubert_embeddings', 'bert_embeddings'] if name == 'multimodal' else ['hubert_embeddings'])
+    labels = test_store.read_rows(['classification'])['classification'].to_numpy(dtype=np.float32)
+    rows = np.sort(np.random.default_rng(seed).choice(len(test_store), size=min(num_samples, len(test_store)), replace=False))
+    samples = [torch.tensor(np.array(test_store['hubert_embeddings'][row]), dtype=torch.float32) for row in rows]
+    if name == 'multimodal':
+        bert = torch.tensor(np.stack([np.array(test_store['bert_embeddings'][row]).reshape(-1) for row in rows]), dtype=torch.float32)
+    else:
+        bert = torch.zeros((len(rows), BERT_EMBEDDING_DIM))
+    return samples, bert, labels[rows], store
+
+
+def export(name, model, directory=EXPORT_DIRECTORY, onnx=False):
+    """
+    Compiles a model with TorchScript, as is and with its Linear and LSTM layers dynamically quantized to int8. The saved files load with torch.jit.load (see load_exported) without the model's class definition.
+
+    :param name: Key of MODELS.
+    :param model: Model in evaluation mode, not modified.
+    :param directory: Directory the files are written to.
+    :param onnx: If True the float model is also exported to ONNX, which needs the onnx package.
+    :returns: Dictionary mapping 'float', 'int8' and, if exported, 'onnx' to the paths written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    model = strip_dropout(copy.deepcopy(model))
+    config = json.dumps({'model': name, 'inputs': INPUTS[name], 'output': 'logit (batch, 1)'})
+    variants = {
+        'float': model,
+        'int8': torch.ao.quantization.quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8),
+    }
+    paths = {}
+    for variant, variant_model in variants.items():
+        paths[variant] = os.path.join(directory, f'{name}.pt' if variant == 'float' else f'{name}.{variant}.pt')
+        torch.jit.save(torch.jit.script(variant_model), paths[variant] + '.tmp', _extra_files={CONFIG_FILE: config})
+        os.replace(paths[variant] + '.tmp', paths[variant])
+
+    if onnx:
+        samples, bert, _, _ = load_test_set(name, num_samples=2)
+        inputs = batch_inputs(name, samples, bert)
+        input_names = [description.split(' (')[0].replace(' ', '_') for description in INPUTS[name]]
+        dynamic_axes = {input_name: {0: 'batch'} for input_name in input_names}
+        if name in ('vad', 'lstm', 'lstm-large'):
+            dynamic_axes[input_names[0]][1] = 'frames'
+        paths['onnx'] = os.path.join(directory, f'{name}.onnx')
+        torch.onnx.export(model, inputs, paths['onnx'], input_names=input_names, output_names=['logit'], dynamic_axes=dynamic_axes, dynamo=False)
+    return paths
+
+def load_exported(path):
+    """
+    :param path: TorchScript file written by export.
+    :returns: Tuple of the model and its config, describing the inputs it takes.
+    """
+    extra_files = {CONFIG_FILE: ''}
+    model = torch.jit.load(path, map_location=torch.device('cpu'), _extra_files=extra_files)
+    return model.eval(), json.loads(extra_files[CONFIG_FILE])
+
+
+def evaluate(name, model, samples, bert, labels=None):
+    """
+    Runs a model on one sample at a time, as the test notebooks do, timing each decision.
+
+    :param name: Key of MODELS.
+    :param model: Eager or exported model.
+    :param samples: List of tensors of shape (frames, features).
+    :param bert: Tensor of BERT embeddings, one row per sample.
+    :param labels: Optional array of labels.
+    :returns: Tuple of the predicted probabilities and a dictionary with latency percentiles per decision in milliseconds and, given labels, the accuracy and macro average F1 score.
+    """
+    probabilities = []
+    latencies = []
+    with torch.inference_mode():
+        for i, sample in enumerate(samples):
+            start_time = time.perf_counter()
+            output = model(*batch_inputs(name, [sample], bert[i:i + 1]))
+            probabilities.append(torch.sigmoid(output.squeeze(1))[0].item())
+            latencies.append(time.perf_counter() - start_time)
+
+    probabilities = np.array(probabilities)
+    latencies_ms = np.array(latencies) * 1000
+    result = {'latency_ms': {**{f'p{p}': float(np.percentile(latencies_ms, p)) for p in PERCENTILES}, 'mean': float(latencies_ms.mean())}}
+    if labels is not None:
+        predictions = probabilities >= TRUE_THRESHOLD
+        result['accuracy'] = float(np.mean(predictions == labels.astype(bool)))
+        result['macro_f1'] = float(f1_score(labels.astype(bool), predictions, average='macro'))
+    return probabilities, result
+
+def compare(name, directory=EXPORT_DIRECTORY, weights_directory=WEIGHTS_DIRECTORY, store=None, num_samples=NUM_SAMPLES, onnx=False):
+    """
+    Exports a model family and compares the exported models with the float eager model: the time to load each, the latency per decision, the size on disk and either the accuracy and F1 score on the test store or, for random samples, only how far the predictions move.
+
+    :param name: Key of MODELS.
+    :param directory: Directory the exported models are written to.
+    :param weights_directory: Directory holding the weights of every model family.
+    :param store: Optional test embedding store.
+    :param num_samples: Number of samples compared on.
+    :param onnx: If True the float model is also exported to ONNX.
+    :returns: Dictionary of results for the eager, float TorchScript and int8 TorchScript models.
+    """
+    start_time = time.perf_counter()
+    eager, weights_path = benchmark.load_model(name, weights_directory, MODELS)
+    eager_load_ms = (time.perf_counter() - start_time) * 1000
+    paths = export(name, eager, directory, onnx)
+    samples, bert, labels, inputs = load_test_set(name, store, num_samples)
+
+    reference, eager_result = evaluate(name, eager, samples, bert, labels)
+    results = {'eager': {'load_ms': eager_load_ms, **eager_result}}
+    for variant in ('float', 'int8'):
+        start_time = time.perf_counter()
+        model, _ = load_exported(paths[variant])
+        load_ms = (time.perf_counter() - start_time) * 1000
+        probabilities, result = evaluate(name, model, samples, bert, labels)
+        results[variant] = {
+            'path': paths[variant],
+            'size_mb': os.path.getsize(paths[variant]) / 1024 ** 2,
+            'load_ms': load_ms,
+            **result,
+            'max_probability_difference': float(np.max(np.abs(probabilities - reference))),
+            'flipped_decisions': int(np.sum((probabilities >= TRUE_THRESHOLD) != (reference >= TRUE_THRESHOLD))),
+        }
+    if 'onnx' in paths:
+        results['onnx'] = {'path': paths['onnx'], 'size_mb': os.path.getsize(paths['onnx']) / 1024 ** 2}
+    return {'model': name, 'weights': weights_path, 'inputs': inputs, 'samples': len(samples), 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the models with TorchScript, float and with dynamic int8 quantization, and compare them with the eager float models.')
+    parser.add_argument('--models', default=','.join(MODELS), help=f'comma separated model families from {", ".join(MODELS)}')
+    parser.add_argument('--weights-dir', default=WEIGHTS_DIRECTORY, help='directory of saved weights, models without weights are randomly initialised')
+    parser.add_argument('--export-dir', default=EXPORT_DIRECTORY, help='directory the exported models and the report are written to')
+    parser.add_argument('--store', default=None, help='test embedding store to compare accuracy and F1 score on, random samples if not given')
+    parser.add_argument('--samples', type=int, default=NUM_SAMPLES, help='number of samples compared on')
+    parser.add_argument('--threads', type=int, default=1, help='number of CPU threads')
+    parser.add_argument('--onnx', action='store_true', help='also export the float models to ONNX, needs the onnx package')
+    args = parser.parse_args()
+
+    names = args.models.split(',')
+    unknown = [name for name in names if name not in MODELS]
+    if unknown:
+        parser.error(f'unknown models {unknown}')
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    report = {'torch': torch.__version__, 'threads': args.threads, 'models': []}
+    for name in names:
+        comparison = compare(name, args.export_dir, args.weights_dir, args.store, args.samples, args.onnx)
+        report['models'].append(comparison)
+        for variant, result in comparison['results'].items():
+            if 'latency_ms' not in result:
+                continue
+            line = f"{name:>10} {variant:>5}: load {result['load_ms']:.1f} ms, p50 {result['latency_ms']['p50']:.3f} ms, p95 {result['latency_ms']['p95']:.3f} ms per decision"
+            if 'macro_f1' in result:
+                line += f", accuracy {result['accuracy']:.4f}, macro F1 {result['macro_f1']:.4f}"
+            if variant != 'eager':
+                line += f", {result['size_mb']:.1f} MB, probability difference from eager max {result['max_probability_difference']:.4f}, {result['flipped_decisions']} decisions flipped"
+            print(line)
+
+    report_path = os.path.join(args.export_dir, 'report.json')
+    with open(report_path + '.tmp', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(report_path + '.tmp', report_path)
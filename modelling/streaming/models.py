@@ -0,0 +1,239 @@
+import os
+import json
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence
+from torch.nn.utils import weight_norm, remove_weight_norm
+
+# model definitions shared by the streaming scripts, copied from the modelling notebooks so that their saved state dicts load unchanged
+
+FIXED_LENGTH = 250 # fixed sequence length the TCN expects as an input, see collate_fn in the TCN notebooks
+SETTINGS_SUFFIX = '.settings.json' # written next to the TCN weights by the TCN notebooks
+
+
+class NormReLUChannelNormalization(nn.Module):
+    def __init__(self, epsilon=1e-5, causal=False):
+        super(NormReLUChannelNormalization, self).__init__()
+        self.epsilon = epsilon
+        self.relu = nn.ReLU()
+        # the trained models normalise by the maximum over the whole sequence, causal normalises each frame by the maximum up to that frame
+        self.causal = causal
+
+    def forward(self, x):
+        x = self.relu(x)
+        if self.causal:
+            max_values, _ = torch.cummax(torch.abs(x), dim=2)
+        else:
+            max_values, _ = torch.max(torch.abs(x), dim=2, keepdim=True)
+        max_values += self.epsilon
+        out = x / max_values
+        return out
+
+class WaveNetActivation(nn.Module):
+    def __init__(self):
+        super(WaveNetActivation, self).__init__()
+
+    def forward(self, x):
+        tanh_out = torch.tanh(x)
+        sigm_out = torch.sigmoid(x)
+        return tanh_out * sigm_out
+
+class Chomp1d(nn.Module):
+    def __init__(self, chomp_size):
+        super(Chomp1d, self).__init__()
+        self.chomp_size = chomp_size
+
+    def forward(self, x):
+        return x[:, :, :-self.chomp_size].contiguous()
+
+class ResidualBlock(nn.Module):
+    def __init__(self, in_channels, out_channels, dilation, kernel_size, activation, dropout=0):
+        super(ResidualBlock, self).__init__()
+        chomp_size = (kernel_size-1) * dilation
+        padding = (kernel_size-1) * dilation
+        self.conv1 = weight_norm(nn.Conv1d(in_channels, out_channels, kernel_size,
+                                           stride=1, padding=padding, dilation=dilation))
+        self.chomp1 = Chomp1d(chomp_size)
+        self.dropout = nn.Dropout(dropout)
+        self.activation = activation
+        self.conv2 = weight_norm(nn.Conv1d(out_channels, out_channels, kernel_size,
+                                           stride=1, padding=padding, dilation=dilation))
+        self.chomp2 = Chomp1d(chomp_size)
+        self.net = nn.Sequential(self.conv1, self.chomp1, self.activation, self.dropout,
+                                 self.conv2, self.chomp2, self.activation, self.dropout)
+        self.downsample = nn.Conv1d(in_channels, out_channels, 1) if in_channels != out_channels else None
+        self.relu = nn.ReLU()
+        self.init_weights()
+
+    def init_weights(self):
+        self.conv1.weight.data.normal_(0, 0.01)
+        self.conv2.weight.data.normal_(0, 0.01)
+        if self.downsample is not None:
+            self.downsample.weight.data.normal_(0, 0.01)
+
+    def forward(self, x):
+        out = self.net(x)
+        res = x if self.downsample is None else self.downsample(x)
+        return self.relu(out + res)
+
+class TemporalConvNet(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size=2, dropout=0):
+        super(TemporalConvNet, self).__init__()
+        layers = []
+        num_levels = len(out_channels)
+        for i in range(num_levels):
+            dilation_size = 2 ** i
+            in_channels = in_channels if i == 0 else out_channels[i-1]
+            activation = NormReLUChannelNormalization() if i%2 == 0 else WaveNetActivation()
+            layers += [ResidualBlock(in_channels, out_channels[i], dilation=dilation_size,
+                                     kernel_size=kernel_size, activation=activation, dropout=dropout)]
+
+        self.network = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.network(x)
+
+class TCN(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size=2, dropout=0):
+        super(TCN, self).__init__()
+        self.tcn = TemporalConvNet(in_channels, out_channels, kernel_size=kernel_size, dropout=dropout)
+        self.linear = nn.Linear(out_channels[-1], 1)
+
+    def forward(self, x):
+        x = x.transpose(1, 2)
+        y1 = self.tcn(x)
+        o = self.linear(y1[:, :, -1])
+        return o
+
+def fold_weight_norm(model):
+    """
+    Folds the weight normalisation of a trained TCN into its convolution weights, so inference does not recompute the normalised weights on every forward pass. Must be called after the state dict is loaded.
+
+    :param model: TCN in evaluation mode, modified in place.
+    :returns: The same model.
+    """
+    for block in model.tcn.network:
+        remove_weight_norm(block.conv1)
+        remove_weight_norm(block.conv2)
+    return model
+
+def set_causal_normalisation(model, causal):
+    """
+    Switches every NormReLUChannelNormalization of a TCN between normalising by the maximum over the whole sequence and by the running maximum. The weights are unaffected.
+
+    :param model: TCN, modified in place.
+    :param causal: True for the running maximum, as computed by StatefulTCN and set by CAUSAL_NORMALISATION in the TCN notebooks.
+    :returns: The same model.
+    """
+    for module in model.modules():
+        if isinstance(module, NormReLUChannelNormalization):
+            module.causal = causal
+    return model
+
+def load_tcn_settings(weights_path):
+    """
+    Reads the training settings the TCN notebooks save next to a TCN's weights (model.pth -> model.settings.json).
+
+    :param weights_path: Path to the TCN's saved state dict.
+    :returns: Dictionary with 'causal_normalisation', False for weights saved before the settings were, which were all trained with the maximum over the whole sequence.
+    """
+    settings_path = os.path.splitext(weights_path)[0] + SETTINGS_SUFFIX
+    settings = {'causal_normalisation': False}
+    if os.path.exists(settings_path):
+        with open(settings_path, 'r') as f:
+            settings.update(json.load(f))
+    return settings
+
+
+class AudioModel(nn.Module):
+    def __init__(self, audio_embedding_dim=768, hidden_dims=[256], output_dim=1, dropout_rate=0):
+        super(AudioModel, self).__init__()
+
+        layers = []
+        prev_dim = audio_embedding_dim
+        for dim in hidden_dims:
+            layers.extend([
+                nn.Linear(prev_dim, dim),
+                nn.ReLU(),
+                nn.Dropout(dropout_rate)
+            ])
+            prev_dim = dim
+
+        self.model = nn.Sequential(*layers)
+
+        self.output_layer = nn.Linear(hidden_dims[-1], output_dim)
+
+    def forward(self, audio_embedding):
+        out = self.model(audio_embedding)
+        return self.output_layer(out)
+
+
+# the AudioModel of the multimodal notebooks, which has no output layer of its own
+class AudioEncoder(nn.Module):
+    def __init__(self, audio_embedding_dim=768, hidden_layers=[], dropout_rate=0.5):
+        super(AudioEncoder, self).__init__()
+
+        layers = []
+        prev_dim = audio_embedding_dim
+        for dim in hidden_layers:
+            layers.extend([
+                nn.Linear(prev_dim, dim),
+                nn.ReLU(),
+                nn.Dropout(dropout_rate)
+            ])
+            prev_dim = dim
+
+        self.model = nn.Sequential(*layers)
+
+    def forward(self, audio_embedding):
+        return self.model(audio_embedding)
+
+# multimodal model combining the BERT context embedding with the pooled HuBERT embedding, see test_average_multimodal_model.ipynb
+class CustomModel(nn.Module):
+    def __init__(self, bert_embedding_dim=768, hubert_embedding_dim=768, hidden_layers=[768, 512, 256], hidden_dim1=256, hidden_dim2=256, bert_hidden_dim=16, output_dim=1, dropout_rate=0.4):
+        super(CustomModel, self).__init__()
+        self.bert_layer1 = nn.Linear(bert_embedding_dim, bert_hidden_dim)
+        self.dropout1 = nn.Dropout(dropout_rate)
+        self.bert_layer2 = nn.Linear(bert_hidden_dim, bert_hidden_dim)
+        self.dropout2 = nn.Dropout(dropout_rate)
+
+        self.audio_model = AudioEncoder(audio_embedding_dim=hubert_embedding_dim, hidden_layers=hidden_layers, dropout_rate=0)
+
+        self.fc1 = nn.Linear(hidden_layers[-1] + bert_hidden_dim, hidden_dim1)
+        self.dropout5 = nn.Dropout(dropout_rate)
+        self.fc2 = nn.Linear(hidden_dim1, hidden_dim2)
+        self.dropout6 = nn.Dropout(dropout_rate)
+        self.output_layer = nn.Linear(hidden_dim2, output_dim)
+
+    def forward(self, bert_embedding, hubert_embedding):
+        bert_out = F.relu(self.bert_layer1(bert_embedding))
+        bert_out = self.dropout1(bert_out)
+        bert_out = F.relu(self.bert_layer2(bert_out))
+        bert_out = self.dropout2(bert_out)
+
+        hubert_out = self.audio_model(hubert_embedding)
+
+        concatenated = torch.cat((bert_out, hubert_out), dim=1)
+
+        fc_out = F.relu(self.fc1(concatenated))
+        fc_out = self.dropout5(fc_out)
+        fc_out = F.relu(self.fc2(fc_out))
+        fc_out = self.dropout6(fc_out)
+
+        return self.output_layer(fc_out)
+
+
+# LSTM Classifier, also used with MFCC features by the VAD baseline
+class Classifier(nn.Module):
+    def __init__(self, embedding_dim, hidden_dim, output_dim, n_layers, bidirectional, dropout_rate):
+        super().__init__()
+        self.rnn = nn.LSTM(embedding_dim, hidden_dim, num_layers=n_layers, bidirectional=bidirectional, dropout=dropout_rate if n_layers > 1 else 0)
+        self.fc = nn.Linear(hidden_dim * 2, output_dim)
+        self.dropout = nn.Dropout(dropout_rate)
+
+    def forward(self, embedding, lengths):
+        packed = pack_padded_sequence(embedding, lengths, batch_first=True, enforce_sorted=False)
+        packed_output, (hidden, cell) = self.rnn(packed)
+        hidden = self.dropout(torch.cat((hidden[-2,:,:], hidden[-1,:,:]), dim=1))
+        return self.fc(hidden)
@@ -0,0 +1,194 @@
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from torch import nn
+from models import Classifier
+
+sys.path.append('../../Dataset')
+
+#### Edit variables and filepaths here ####
+LOOKBACK_FRAMES = 50 # frames the backward direction of a bidirectional model sees, 1 s of HuBERT frames
+BENCHMARK_LOOKBACKS = [15, 50, 100, 200]
+TRUE_THRESHOLD = 0.5
+
+# input size, hidden units, layers and frames per 300 ms decision of each model, see test_LSTM_model.ipynb (LARGE_LSTM) and test_VAD.ipynb
+# HuBERT emits a frame every 20 ms and the VAD's MFCC transform every 10 ms
+MODEL_CONFIGS = {
+    'lstm': (768, 256, 2, 15),
+    'lstm-large': (768, 768, 4, 15),
+    'vad': (13, 64, 1, 30),
+}
+
+
+def direction_lstm(rnn, suffix):
+    """
+    Copies one direction of the first layer of a bidirectional LSTM into a unidirectional LSTM.
+
+    :param rnn: Bidirectional nn.LSTM.
+    :param suffix: '' for the forward direction, '_reverse' for the backward direction.
+    :returns: Single layer nn.LSTM in evaluation mode.
+    """
+    lstm = nn.LSTM(rnn.input_size, rnn.hidden_size, num_layers=1, bias=rnn.bias)
+    with torch.no_grad():
+        for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh') if rnn.bias else ('weight_ih', 'weight_hh'):
+            getattr(lstm, f'{name}_l0').copy_(getattr(rnn, f'{name}_l0{suffix}'))
+    return lstm.eval()
+
+
+class StatefulLSTM:
+    """
+    Streaming inference for the LSTM Classifier, consuming only the frames that arrived since the previous decision instead of re-running pack_padded_sequence and the LSTM over the whole prefix.
+    - Unidirectional models carry (h, c) of every layer between calls and are exact.
+    - Single layer bidirectional models (the VAD baseline) carry the forward direction's (h, c) exactly. The backward direction has to start from the newest frame, so it is re-run over the last `lookback` frames only.
+    - Stacked bidirectional models (test_LSTM_model.ipynb) feed both directions of each layer into the next, so even the upper forward directions depend on future frames; the whole LSTM is re-run over the last `lookback` frames.
+    Bidirectional models are therefore approximated, with a cost per decision bounded by the lookback rather than the length of the utterance; benchmark measures the effect of the lookback. lookback=None keeps every frame, which is exact but grows like the full forward.
+    """
+    def __init__(self, model, lookback=LOOKBACK_FRAMES):
+        """
+        :param model: Trained Classifier in evaluation mode.
+        :param lookback: Number of most recent frames the backward direction sees, or None for all frames.
+        """
+        self.model = model
+        self.rnn = model.rnn
+        self.lookback = lookback
+        if self.rnn.bidirectional and self.rnn.num_layers == 1:
+            self.forward_rnn = direction_lstm(self.rnn, '')
+            self.backward_rnn = direction_lstm(self.rnn, '_reverse')
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the state, e.g. at the onset of a new overlap.
+        """
+        self.state = None # (h, c) carried by the exact forward directions
+        self.window = torch.zeros((0, self.rnn.input_size)) # most recent frames, for the bidirectional approximation
+        self.num_frames = 0
+
+    @torch.inference_mode()
+    def step_frames(self, frames):
+        """
+        Consumes the frames that arrived since the previous call.
+
+        :param frames: Tensor of shape (frames, input size).
+        :returns: Logit for the sequence so far, or None if no frames have been seen.
+        """
+        self.num_frames += len(frames)
+        if self.num_frames == 0:
+            return None
+        frames = frames.unsqueeze(1) # the LSTM is not batch_first: (frames, batch, features)
+        if self.rnn.bidirectional:
+            self.window = torch.cat([self.window, frames[:, 0]])
+            if self.lookback is not None:
+                self.window = self.window[-self.lookback:]
+
+        if not self.rnn.bidirectional:
+            if len(frames):
+                _, self.state = self.rnn(frames, self.state)
+            hidden = self.state[0]
+        elif self.rnn.num_layers == 1:
+            if len(frames):
+                _, self.state = self.forward_rnn(frames, self.state)
+            _, (backward_hidden, _) = self.backward_rnn(torch.flip(self.window, dims=[0]).unsqueeze(1))
+            hidden = torch.cat([self.state[0], backward_hidden])
+        else:
+            _, (hidden, _) = self.rnn(self.window.unsqueeze(1))
+        return self.model.fc(torch.cat((hidden[-2], hidden[-1]), dim=1)).item()
+
+
+def full_forward(model, prefix):
+    """
+    The per-prefix inference of the test notebooks: pack_padded_sequence and the whole LSTM over the prefix.
+
+    :param model: Classifier in evaluation mode.
+    :param prefix: Tensor of shape (frames, input size).
+    :returns: Logit.
+    """
+    with torch.inference_mode():
+        return model(prefix.unsqueeze(0), [len(prefix)]).item()
+
+def benchmark(model, sequences, frames_per_decision, lookbacks=BENCHMARK_LOOKBACKS):
+    """
+    Streams sequences through the model one decision at a time, comparing the latency of re-running the full forward on each prefix with StatefulLSTM, and for bidirectional models the effect of each lookback on the predicted probability.
+
+    :param model: Classifier in evaluation mode.
+    :param sequences: List of tensors of shape (frames, input size).
+    :param frames_per_decision: Frames between decisions.
+    :param lookbacks: Lookbacks to measure, only used by bidirectional models.
+    :returns: Dictionary of per-decision latencies in seconds and probability differences for each mode.
+    """
+    modes = {'full': None}
+    if model.rnn.bidirectional:
+        modes.update({f'lookback {lookback}': StatefulLSTM(model, lookback) for lookback in lookbacks})
+    else:
+        modes['stateful'] = StatefulLSTM(model)
+    latencies = {name: [] for name in modes} # one list of latencies per decision index
+    differences = {name: [] for name in modes}
+    flips = {name: 0 for name in modes}
+    num_decisions = 0
+    for sequence in sequences:
+        for stateful in modes.values():
+            if stateful is not None:
+                stateful.reset()
+        for i, start in enumerate(range(0, len(sequence), frames_per_decision)):
+            end = min(start + frames_per_decision, len(sequence))
+            start_time = time.perf_counter()
+            reference = torch.sigmoid(torch.tensor(full_forward(model, sequence[:end]))).item()
+            timings = {'full': time.perf_counter() - start_time}
+            probabilities = {'full': reference}
+            for name, stateful in modes.items():
+                if stateful is None:
+                    continue
+                start_time = time.perf_counter()
+                logit = stateful.step_frames(sequence[start:end])
+                timings[name] = time.perf_counter() - start_time
+                probabilities[name] = torch.sigmoid(torch.tensor(logit)).item()
+            for name in modes:
+                if len(latencies[name]) <= i:
+                    latencies[name].append([])
+                latencies[name][i].append(timings[name])
+                differences[name].append(abs(probabilities[name] - reference))
+                flips[name] += (probabilities[name] >= TRUE_THRESHOLD) != (reference >= TRUE_THRESHOLD)
+            num_decisions += 1
+
+    print(f'{len(sequences)} sequences, {num_decisions} decisions of {frames_per_decision} frames')
+    for name in modes:
+        per_decision_ms = np.array([np.mean(decision) for decision in latencies[name]]) * 1000
+        line = f'{name:>14}: mean {per_decision_ms.mean():.2f} ms per decision, first decision {per_decision_ms[0]:.2f} ms, last decision {per_decision_ms[-1]:.2f} ms'
+        if name != 'full':
+            line += f', probability difference from full mean {np.mean(differences[name]):.4f} max {np.max(differences[name]):.4f}, {flips[name]} decisions flipped'
+        print(line)
+    return {'latencies': latencies, 'differences': differences, 'flips': flips}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark streaming LSTM inference against re-running the full prefix.')
+    parser.add_argument('--model', choices=list(MODEL_CONFIGS), default='lstm', help='model configuration')
+    parser.add_argument('--weights', default=None, help="path to the model's weights, randomly initialised if not given")
+    parser.add_argument('--store', default=None, help='embedding store to stream sequences from, random sequences if not given')
+    parser.add_argument('--column', default='hubert_embeddings', help='embedding column streamed from --store')
+    parser.add_argument('--sequences', type=int, default=20, help='number of sequences streamed')
+    parser.add_argument('--seconds', type=float, default=5, help='length of each random sequence')
+    parser.add_argument('--lookbacks', default=','.join(map(str, BENCHMARK_LOOKBACKS)), help='comma separated lookbacks in frames')
+    parser.add_argument('--threads', type=int, default=1, help='number of CPU threads')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    input_size, hidden_size, num_layers, frames_per_decision = MODEL_CONFIGS[args.model]
+    model = Classifier(input_size, hidden_size, 1, num_layers, True, 0)
+    if args.weights:
+        model.load_state_dict(torch.load(args.weights, map_location=torch.device('cpu')))
+    model.eval()
+
+    if args.store:
+        from embedding_store import EmbeddingStore
+        column = EmbeddingStore(args.store, [args.column])[args.column]
+        # the longest prefixes, which show most clearly how latency grows with the utterance
+        rows = np.argsort(column.lengths())[::-1][:args.sequences]
+        sequences = [torch.tensor(np.array(column[row]), dtype=torch.float32) for row in rows]
+    else:
+        num_frames = int(args.seconds * 1000 / 300 * frames_per_decision)
+        sequences = [torch.randn((num_frames, input_size)) for _ in range(args.sequences)]
+    benchmark(model, sequences, frames_per_decision, [int(lookback) for lookback in args.lookbacks.split(',')])
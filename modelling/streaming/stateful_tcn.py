@@ -0,0 +1,299 @@
+import time
+import argparse
+import numpy as np
+import torch
+from models import TCN, FIXED_LENGTH, NormReLUChannelNormalization, fold_weight_norm, set_causal_normalisation, load_tcn_settings
+
+
+class RingBuffer:
+    """
+    Holds the inputs a dilated causal convolution still needs from earlier steps, the last (kernel_size - 1) * dilation frames. Starts as zeros, matching the convolution's left padding.
+    """
+    def __init__(self, channels, kernel_size, dilation):
+        self.size = (kernel_size - 1) * dilation
+        self.buffer = torch.zeros((self.size, channels))
+        self.position = 0 # slot of the oldest frame
+        self.offsets = torch.arange(self.size)
+
+    def extend(self, frames):
+        """
+        Appends new frames, overwriting the oldest ones.
+
+        :param frames: Tensor of shape (frames, channels).
+        :returns: Tensor of shape (size + frames, channels) holding the buffered frames, oldest first, followed by the new frames: the window the convolution reads.
+        """
+        if self.size == 0:
+            return frames
+        window = torch.cat([self.buffer[(self.position + self.offsets) % self.size], frames])
+        kept = frames[-self.size:]
+        self.buffer[(self.position + self.offsets[:len(kept)]) % self.size] = kept
+        self.position = (self.position + len(kept)) % self.size
+        return window
+
+    def reset(self):
+        self.buffer.zero_()
+        self.position = 0
+
+    def snapshot(self):
+        return self.buffer.clone(), self.position
+
+    def restore(self, state):
+        buffer, self.position = state
+        self.buffer.copy_(buffer)
+
+
+class StatefulConv:
+    """
+    A dilated causal Conv1d (with its chomp) applied to new frames only, reading the frames before them from a ring buffer.
+    """
+    def __init__(self, conv):
+        """
+        :param conv: nn.Conv1d, with or without weight normalisation.
+        """
+        if hasattr(conv, 'weight_g'):
+            weight = conv.weight_g * conv.weight_v / torch.linalg.vector_norm(conv.weight_v, dim=(1, 2), keepdim=True)
+        else:
+            weight = conv.weight
+        out_channels, in_channels, kernel_size = weight.shape
+        # (out, in, k) -> (k * in, out) so that the taps of each frame, flattened oldest first, multiply it in one matrix product
+        self.weight = weight.detach().permute(2, 1, 0).reshape(kernel_size * in_channels, out_channels).contiguous()
+        self.bias = conv.bias.detach()
+        self.kernel_size = kernel_size
+        self.dilation = conv.dilation[0]
+        self.history = RingBuffer(in_channels, kernel_size, self.dilation)
+
+    def step_frames(self, frames):
+        """
+        :param frames: Tensor of shape (frames, in_channels).
+        :returns: Tensor of shape (frames, out_channels).
+        """
+        window = self.history.extend(frames)
+        taps = torch.cat([window[i * self.dilation:i * self.dilation + len(frames)] for i in range(self.kernel_size)], dim=1)
+        return torch.addmm(self.bias, taps, self.weight)
+
+    def reset(self):
+        self.history.reset()
+
+    def snapshot(self):
+        return self.history.snapshot()
+
+    def restore(self, state):
+        self.history.restore(state)
+
+
+class StatefulActivation:
+    """
+    A TCN activation applied to new frames only. NormReLUChannelNormalization keeps the running maximum of each channel, so a frame is normalised by the maximum up to and including it.
+    """
+    def __init__(self, activation, channels):
+        self.activation = activation
+        self.normalise = isinstance(activation, NormReLUChannelNormalization)
+        self.running_max = torch.zeros(channels)
+
+    def step_frames(self, x):
+        if not self.normalise:
+            return self.activation(x)
+        x = torch.relu(x)
+        max_values, _ = torch.cummax(torch.cat([self.running_max[None], x]), dim=0)
+        self.running_max = max_values[-1]
+        return x / (max_values[1:] + self.activation.epsilon)
+
+    def reset(self):
+        self.running_max.zero_()
+
+    def snapshot(self):
+        return self.running_max.clone()
+
+    def restore(self, state):
+        self.running_max = state.clone()
+
+
+class StatefulTCN:
+    """
+    Incremental inference for a TCN: each new embedding frame is pushed through every residual block once, reading the block's earlier inputs from ring buffers. A frame costs O(layers) whatever the length of the sequence, where the full forward recomputes every frame of the prefix. Frames arriving together, such as the 15 frames of a 300 ms decision, are processed as one chunk.
+    As in the notebooks, the prefix is zero-padded to FIXED_LENGTH frames and the prediction read from the last frame. Only the first receptive_field padding frames change that prediction, so they are run from a copy of the carried state after each chunk and the state is then restored; frames beyond max_frames are ignored, as collate_fn truncates them.
+    The output after frame t equals the padded forward with causal normalisation (see set_causal_normalisation), so it reproduces TCNs trained with CAUSAL_NORMALISATION in the TCN notebooks. TCNs trained without it normalise by the maximum over the whole padded sequence, where a new maximum rescales every earlier frame and so changes the input of every later layer; no incremental computation reproduces that, and the detector refuses them.
+    """
+    def __init__(self, model, max_frames=FIXED_LENGTH):
+        """
+        :param model: TCN in evaluation mode, its weights are read once and the model is left unchanged.
+        :param max_frames: Length the notebooks pad and truncate the sequences to.
+        """
+        self.blocks = []
+        for block in model.tcn.network:
+            out_channels = block.conv1.out_channels
+            self.blocks.append({
+                'conv1': StatefulConv(block.conv1),
+                'activation1': StatefulActivation(block.activation, out_channels),
+                'conv2': StatefulConv(block.conv2),
+                'activation2': StatefulActivation(block.activation, out_channels),
+                'downsample': block.downsample,
+            })
+        self.linear = model.linear
+        self.max_frames = max_frames
+        self.receptive_field = receptive_field(model)
+        self.num_frames = 0
+        self.logit = None
+
+    def reset(self):
+        """
+        Clears the state, e.g. at the onset of a new overlap.
+        """
+        for block in self.blocks:
+            for name in ('conv1', 'activation1', 'conv2', 'activation2'):
+                block[name].reset()
+        self.num_frames = 0
+        self.logit = None
+
+    def snapshot(self):
+        return [{name: block[name].snapshot() for name in ('conv1', 'activation1', 'conv2', 'activation2')} for block in self.blocks]
+
+    def restore(self, state):
+        for block, block_state in zip(self.blocks, state):
+            for name, value in block_state.items():
+                block[name].restore(value)
+
+    def forward_frames(self, x):
+        """
+        Pushes frames through every residual block, updating the state.
+
+        :param x: Tensor of shape (frames, in_channels).
+        :returns: Tensor of shape (frames, out_channels) of the last block.
+        """
+        for block in self.blocks:
+            out = block['activation1'].step_frames(block['conv1'].step_frames(x))
+            out = block['activation2'].step_frames(block['conv2'].step_frames(out))
+            res = x if block['downsample'] is None else block['downsample'](x.T.unsqueeze(0))[0].T
+            x = torch.relu(out + res)
+        return x
+
+    @torch.inference_mode()
+    def step_frames(self, frames):
+        """
+        Consumes new embedding frames. Each residual block processes only these frames and the padding frames after them, so the cost grows with their number and not with the length of the sequence so far.
+
+        :param frames: Tensor of shape (frames, in_channels), e.g. the 15 frames of a 300 ms decision.
+        :returns: Logit for the prefix ending with the last frame zero-padded as in the notebooks, or None if no frames were consumed yet.
+        """
+        frames = frames[:self.max_frames - self.num_frames]
+        if len(frames) == 0:
+            return self.logit
+        x = self.forward_frames(frames)
+        self.num_frames += len(frames)
+        num_padding = min(self.receptive_field, self.max_frames - self.num_frames)
+        if num_padding > 0:
+            state = self.snapshot()
+            x = self.forward_frames(torch.zeros((num_padding, frames.shape[1])))
+            self.restore(state)
+        self.logit = self.linear(x[-1]).item()
+        return self.logit
+
+    def step(self, frame):
+        """
+        Consumes one embedding frame.
+
+        :param frame: Tensor of shape (in_channels,).
+        :returns: Logit for the prefix ending with this frame.
+        """
+        return self.step_frames(frame[None])
+
+
+def receptive_field(model):
+    """
+    :param model: TCN.
+    :returns: Number of input frames each output frame depends on, through the two dilated convolutions of every residual block.
+    """
+    return 1 + sum((block.conv1.kernel_size[0] - 1) * block.conv1.dilation[0] + (block.conv2.kernel_size[0] - 1) * block.conv2.dilation[0] for block in model.tcn.network)
+
+def padded_forward(model, prefix, max_frames=FIXED_LENGTH):
+    """
+    The forward of the notebooks: the prefix is truncated or zero-padded to max_frames frames and the prediction read from the last one.
+
+    :param model: TCN in evaluation mode.
+    :param prefix: Tensor of shape (frames, in_channels).
+    :param max_frames: Length the sequence is padded to.
+    :returns: Logit.
+    """
+    padded = torch.zeros((1, max_frames, prefix.shape[1]))
+    padded[0, :len(prefix)] = prefix[:max_frames]
+    return model(padded).item()
+
+
+def benchmark(model, causal=True, num_frames=FIXED_LENGTH, dim=768, frames_per_decision=15, seed=0):
+    """
+    Streams random embedding frames through a TCN, comparing a StatefulTCN step with recomputing the padded forward of the notebooks over the prefix after every frame, and again one decision (frames_per_decision frames) at a time. Prints the latency of both and the difference of their outputs.
+
+    :param model: TCN in evaluation mode, with its weight normalisation folded as in the detector. It is left with the normalisation given by causal.
+    :param causal: Whether the model was trained with CAUSAL_NORMALISATION. Its padded forward with that normalisation is the reference, the other normalisation is reported alongside.
+    :param num_frames: Length of the streamed sequence.
+    :param dim: Size of each embedding frame.
+    :param frames_per_decision: Frames per chunk, 15 HuBERT frames make up the 300 ms between the streaming detector's decisions.
+    :param seed: Seed for the random frames.
+    :returns: Dictionary of per-frame latencies in seconds and output differences.
+    """
+    frames = torch.randn((num_frames, dim), generator=torch.Generator().manual_seed(seed))
+    stateful = StatefulTCN(model)
+    logits, stateful_latencies, full_latencies, differences, other_differences = [], [], [], [], []
+    with torch.inference_mode():
+        for t in range(num_frames):
+            start_time = time.perf_counter()
+            logit = stateful.step(frames[t])
+            stateful_latencies.append(time.perf_counter() - start_time)
+            logits.append(logit)
+
+            prefix = frames[:t + 1]
+            set_causal_normalisation(model, causal)
+            start_time = time.perf_counter()
+            original = padded_forward(model, prefix)
+            full_latencies.append(time.perf_counter() - start_time)
+            differences.append(abs(logit - original))
+
+            set_causal_normalisation(model, not causal)
+            other_differences.append(abs(logit - padded_forward(model, prefix)))
+        set_causal_normalisation(model, causal)
+
+        # the detector hands over the frames of each decision together
+        chunked = StatefulTCN(model)
+        decision_latencies, chunk_differences = [], []
+        for t in range(0, num_frames, frames_per_decision):
+            start_time = time.perf_counter()
+            logit = chunked.step_frames(frames[t:t + frames_per_decision])
+            decision_latencies.append(time.perf_counter() - start_time)
+            chunk_differences.append(abs(logit - logits[min(t + frames_per_decision, num_frames) - 1]))
+
+    results = {'stateful': np.array(stateful_latencies), 'full': np.array(full_latencies), 'difference': np.array(differences), 'other_difference': np.array(other_differences), 'decision': np.array(decision_latencies), 'chunk_difference': np.array(chunk_differences)}
+    for name in ('stateful', 'full'):
+        latencies_ms = results[name] * 1000
+        print(f'{name:>8}: mean {latencies_ms.mean():.2f} ms, p95 {np.percentile(latencies_ms, 95):.2f} ms per frame, {latencies_ms[:10].mean():.2f} ms over the first 10 frames and {latencies_ms[-10:].mean():.2f} ms over the last 10')
+    print(f"Speed-up per frame: {results['full'].mean() / results['stateful'].mean():.1f}x over {num_frames} frames")
+    decision_full_ms = results['full'][frames_per_decision - 1::frames_per_decision] * 1000
+    print(f"Per decision of {frames_per_decision} frames: stateful mean {results['decision'].mean() * 1000:.2f} ms, full recompute mean {decision_full_ms.mean():.2f} ms (last {decision_full_ms[-1]:.2f} ms), max difference between chunked and per-frame steps {results['chunk_difference'].max():.2e}")
+    normalisations = ('global maximum', 'causal') if causal else ('causal', 'global maximum')
+    print(f"Logit difference from the padded forward of the model as trained ({normalisations[1]} normalisation): mean {results['difference'].mean():.2e}, max {results['difference'].max():.2e}")
+    print(f"Logit difference from the padded forward with {normalisations[0]} normalisation: mean {results['other_difference'].mean():.4f}, max {results['other_difference'].max():.4f}")
+    return results
+
+
+if __name__ == "__main__":
+    from detector import TCN_LAYERS, NUM_THREADS
+
+    parser = argparse.ArgumentParser(description='Benchmark incremental TCN inference against recomputing the full sequence.')
+    parser.add_argument('--weights', default=None, help="path to the TCN's weights, randomly initialised if not given")
+    parser.add_argument('--frames', type=int, default=FIXED_LENGTH, help='number of frames streamed')
+    parser.add_argument('--threads', type=int, default=NUM_THREADS, help='number of CPU threads')
+    parser.add_argument('--allow-global-normalisation', action='store_true', help='benchmark weights not trained with CAUSAL_NORMALISATION, whose outputs StatefulTCN does not reproduce')
+    args = parser.parse_args()
+
+    # random weights stand in for a TCN trained with causal normalisation
+    causal = load_tcn_settings(args.weights)['causal_normalisation'] if args.weights else True
+    if not causal:
+        if not args.allow_global_normalisation:
+            parser.error(f'{args.weights} was not trained with CAUSAL_NORMALISATION (no causal_normalisation in its settings file), StatefulTCN cannot reproduce its outputs. Pass --allow-global-normalisation to measure by how much they differ.')
+        print(f'WARNING: {args.weights} normalises by the maximum over the whole sequence, the stateful outputs below are not those of the trained model')
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = TCN(768, TCN_LAYERS, kernel_size=2, dropout=0)
+    if args.weights:
+        model.load_state_dict(torch.load(args.weights, map_location=torch.device('cpu')))
+    benchmark(fold_weight_norm(model.eval()), causal, args.frames)